@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""渲染和解析热点路径的微基准
+
+用合成数据（10 ~ 100000 条划线）测量纯 Python 部分的 CPU 时间和内存分配，
+不访问网络。结果写成 JSON，可作为基线，之后的运行和基线比较发现性能回退。
+
+    python bench_weread.py --output bench_baseline.json
+    python bench_weread.py --baseline bench_baseline.json --max-regression 0.2
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import weread_api
+
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000]
+
+
+class _FakeResponse:
+    def __init__(self, data):
+        self.status_code = 200
+        self.ok = True
+        self.headers = {}
+        self._data = data
+        self.content = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.text = ""
+
+    def json(self):
+        return self._data
+
+
+class _FakeSession:
+    """按固定数据返回 WeRead 响应"""
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def request(self, method, url, params=None, **kwargs):
+        index = (params or {}).get("maxIdx", 0) // weread_api.WEREAD_REVIEW_PAGE_SIZE
+        return _FakeResponse(self.pages[index])
+
+
+def make_bookmarks(count, seed=0):
+    """合成划线数据 - 每章约50条"""
+    rng = random.Random(seed)
+    bookmarks = []
+    for i in range(count):
+        chapter_uid = i // 50 + 1
+        start = rng.randint(0, 20000)
+        bookmarks.append({
+            "bookmarkId": f"bm_{i}",
+            "chapterUid": chapter_uid,
+            "chapterName": f"第{chapter_uid}章",
+            "chapterIdx": chapter_uid,
+            "markText": "划线内容" * rng.randint(5, 40),
+            "style": rng.randint(0, 2),
+            "colorStyle": rng.randint(0, 5),
+            "range": f"{start}-{start + rng.randint(10, 300)}",
+        })
+    rng.shuffle(bookmarks)
+    return bookmarks
+
+
+def make_review_pages(count, seed=0):
+    """合成分页的笔记列表响应"""
+    rng = random.Random(seed)
+    items = []
+    for i in range(count):
+        review_type = 4 if i % 20 == 0 else 1
+        start = rng.randint(0, 20000)
+        items.append({"review": {
+            "reviewId": f"rv_{i}",
+            "type": review_type,
+            "chapterUid": i // 50 + 1,
+            "content": "想法内容" * rng.randint(5, 30),
+            "range": f"{start}-{start + 50}",
+        }})
+    size = weread_api.WEREAD_REVIEW_PAGE_SIZE
+    pages = [{"reviews": items[i:i + size], "hasMore": i + size < len(items)} for i in range(0, len(items), size)]
+    return pages or [{"reviews": [], "hasMore": False}]
+
+
+def make_cookie(count):
+    return "; ".join([f"key{i}=value{i}" for i in range(count)] + ["wr_skey=abcdef", "wr_vid=123"])
+
+
+def _measure(func, repeat):
+    """返回 (最好一次的秒数, 一次调用的内存分配峰值字节数)"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.process_time()
+        func()
+        best = min(best, time.process_time() - start)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def build_cases(size):
+    """每个用例返回一个无参函数"""
+    bookmarks = make_bookmarks(size)
+    review_pages = make_review_pages(size)
+    summary = [p for page in review_pages for p in page["reviews"] if p["review"]["type"] == 4]
+    children = [weread_api.get_callout(b["markText"], b["style"], b["colorStyle"], None) for b in bookmarks]
+    cookie = make_cookie(max(10, size // 100))
+    reviews = [dict(p["review"], markText=p["review"]["content"])
+               for page in review_pages for p in page["reviews"] if p["review"]["type"] == 1]
+    chapter = {uid: {"chapterUid": uid, "chapterIdx": uid} for uid in range(1, size // 50 + 2)}
+    bookmark_response = _FakeResponse({"synckey": 1, "updated": bookmarks, "chapters": list(chapter.values())})
+
+    def add_children_chunks():
+        original = weread_api.notion_api_request
+        weread_api.notion_api_request = lambda *args, **kwargs: {"results": []}
+        try:
+            weread_api.add_children("page", children, "token")
+        finally:
+            weread_api.notion_api_request = original
+
+    return {
+        "sort_bookmarks": lambda: weread_api.sort_bookmarks(bookmarks),
+        "merge_highlights": lambda: weread_api.merge_highlights(bookmarks, reviews, chapter),
+        "get_children": lambda: weread_api.get_children({}, bookmarks, summary, []),
+        "get_callout": lambda: [weread_api.get_callout(b["markText"], b["style"], b["colorStyle"], None)
+                                for b in bookmarks],
+        "parse_bookmark_list": lambda: json.loads(bookmark_response.content),
+        "get_review_list": lambda: weread_api.get_review_list(_FakeSession(review_pages), "book", cookie),
+        "parse_cookie_string": lambda: [weread_api.parse_cookie_string(cookie) for _ in range(size)],
+        "update_wr_skey_in_cookie": lambda: [weread_api.update_wr_skey_in_cookie(cookie, "new") for _ in range(size)],
+        "add_children_chunking": add_children_chunks,
+        "encode_blocks": lambda: weread_api.encode_blocks(children),
+    }
+
+
+def run(sizes, repeat):
+    results = {}
+    for size in sizes:
+        # 大数据量下减少重复次数
+        size_repeat = max(1, repeat if size <= 10000 else 1)
+        for name, func in build_cases(size).items():
+            with contextlib.redirect_stdout(io.StringIO()):
+                seconds, peak = _measure(func, size_repeat)
+            key = f"{name}[{size}]"
+            results[key] = {
+                "size": size,
+                "cpu_seconds": seconds,
+                "cpu_us_per_item": seconds / size * 1e6,
+                "peak_alloc_bytes": peak,
+                "alloc_bytes_per_item": peak / size,
+            }
+            print(f"{key:40s} {seconds * 1e3:10.2f} ms  {seconds / size * 1e6:8.2f} us/条  "
+                  f"{peak / 1024:10.1f} KiB")
+    return results
+
+
+def compare(results, baseline, max_regression):
+    """与基线比较，返回回退的用例"""
+    regressions = []
+    for key, current in results.items():
+        base = baseline.get("results", {}).get(key)
+        if not base:
+            continue
+        for metric in ("cpu_seconds", "peak_alloc_bytes"):
+            if base[metric] > 0 and current[metric] > base[metric] * (1 + max_regression):
+                regressions.append((key, metric, base[metric], current[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="渲染和解析热点路径的微基准")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="合成书籍的划线数")
+    parser.add_argument("--repeat", type=int, default=5, help="每个用例重复次数，取最好一次")
+    parser.add_argument("--output", help="结果写入JSON文件，可作为基线")
+    parser.add_argument("--baseline", help="与基线JSON比较")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="允许的回退比例，超过则退出码为1")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.repeat)
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "created": int(time.time()),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ 结果已写入 {args.output}")
+
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.max_regression)
+        for key, metric, base, current in regressions:
+            print(f"🔴 {key} {metric}: {base:.6g} → {current:.6g}")
+        if regressions:
+            return 1
+        print("✅ 没有超过阈值的性能回退")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
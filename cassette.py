@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""HTTP 录制/回放 - 把 WeRead 和 Notion 的请求响应录进压缩的 cassette 文件，离线回放
+
+在 requests.Session.request 这一层拦截，WeRead 的 session 和 notion_api_request
+（requests.post/get/... 内部也走 Session.request）都会经过这里。
+录制时 Cookie、Authorization、Set-Cookie 等敏感信息会被脱敏。
+"""
+import gzip
+import hashlib
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# 录制时需要脱敏的请求/响应头
+SENSITIVE_HEADERS = {"authorization", "cookie", "set-cookie"}
+REDACTED = "<redacted>"
+
+_original_request = requests.Session.request
+
+
+def _body_text(kwargs):
+    """请求体转成稳定的字符串，用于匹配"""
+    if kwargs.get("json") is not None:
+        return json.dumps(kwargs["json"], sort_keys=True, ensure_ascii=False)
+    data = kwargs.get("data")
+    if isinstance(data, bytes):
+        return data.decode("utf-8", "replace")
+    return data if isinstance(data, str) else ""
+
+
+def _request_key(method, url, kwargs):
+    params = kwargs.get("params") or {}
+    params_text = json.dumps(sorted((str(k), str(v)) for k, v in dict(params).items()))
+    body_hash = hashlib.sha1(_body_text(kwargs).encode("utf-8")).hexdigest()
+    return f"{method.upper()} {url} {params_text} {body_hash}"
+
+
+def _redact_headers(headers):
+    return {k: (REDACTED if k.lower() in SENSITIVE_HEADERS else v) for k, v in (headers or {}).items()}
+
+
+class Cassette:
+    """一个 cassette 文件 - mode 为 record 或 replay；latency 为 original（按录制耗时等待）或 zero"""
+
+    def __init__(self, path, mode="record", latency="zero"):
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.entries = []
+        self.by_key = {}
+        self.by_route = {}
+        self.misses = 0
+        if mode == "replay":
+            self._load()
+
+    def _load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                self.entries.append(entry)
+                self.by_key.setdefault(entry["key"], []).append(entry)
+                self.by_route.setdefault((entry["method"], entry["url"]), []).append(entry)
+        print(f"📼 已加载 cassette: {self.path}，共 {len(self.entries)} 条请求")
+
+    def record(self, method, url, kwargs, response, elapsed):
+        entry = {
+            "key": _request_key(method, url, kwargs),
+            "method": method.upper(),
+            "url": url,
+            "params": {str(k): str(v) for k, v in dict(kwargs.get("params") or {}).items()},
+            "request_headers": _redact_headers(kwargs.get("headers")),
+            "status": response.status_code,
+            "headers": _redact_headers(dict(response.headers)),
+            "body": response.content.decode("utf-8", "replace"),
+            "elapsed": round(elapsed, 4),
+        }
+        with self.lock:
+            self.entries.append(entry)
+
+    def _take(self, method, url, kwargs):
+        """优先按完整请求匹配，请求体不同（如时间戳）时退回按 方法+URL 顺序匹配"""
+        with self.lock:
+            queue = self.by_key.get(_request_key(method, url, kwargs))
+            if not queue:
+                queue = self.by_route.get((method.upper(), url))
+            if not queue:
+                self.misses += 1
+                return None
+            entry = queue.pop(0)
+            # 同一条记录只回放一次
+            for other in (self.by_key.get(entry["key"], []), self.by_route.get((entry["method"], entry["url"]), [])):
+                if entry in other:
+                    other.remove(entry)
+            return entry
+
+    def replay(self, method, url, kwargs):
+        entry = self._take(method, url, kwargs)
+        if entry is None:
+            raise requests.ConnectionError(f"cassette 中没有匹配的请求: {method.upper()} {url}")
+        if self.latency == "original":
+            time.sleep(entry["elapsed"])
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response._content = entry["body"].encode("utf-8")
+        response.encoding = "utf-8"
+        response.url = url
+        response.elapsed = timedelta(seconds=entry["elapsed"])
+        return response
+
+    def save(self):
+        with self.lock:
+            entries = list(self.entries)
+        with gzip.open(self.path, "wt", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        print(f"📼 已保存 cassette: {self.path}，共 {len(entries)} 条请求")
+
+
+@contextmanager
+def use_cassette(path, mode="record", latency="zero"):
+    """在上下文中录制或回放所有经过 requests 的 HTTP 请求"""
+    cassette = Cassette(path, mode, latency)
+
+    def patched_request(session, method, url, **kwargs):
+        if cassette.mode == "replay":
+            return cassette.replay(method, url, kwargs)
+        start = time.perf_counter()
+        response = _original_request(session, method, url, **kwargs)
+        cassette.record(method, url, kwargs, response, time.perf_counter() - start)
+        return response
+
+    requests.Session.request = patched_request
+    try:
+        yield cassette
+    finally:
+        requests.Session.request = _original_request
+        if mode == "record":
+            cassette.save()
+        elif cassette.misses:
+            print(f"⚠️ 回放时有 {cassette.misses} 个请求未在 cassette 中找到")
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""WeRead GET 接口的持久化 HTTP 缓存
+
+- 响应体 gzip 压缩后存盘，索引记录 ETag / Last-Modified / 内容哈希
+- 服务端给了 ETag / Last-Modified 时发条件请求，304 直接用缓存
+- 没有的话按响应体哈希判断是否变化
+- 每本书成功写入后记录当时各响应的哈希和内容哈希（written.json），
+  下次所有响应都与"上次写入时"一致才跳过渲染（不能和缓存中最近一次看到的哈希比较：
+  写入失败的书下次会被误判为未变化）
+- 总大小超过上限时按 LRU 淘汰
+- read_only 时（预演）照常读取缓存、计算哈希，但不写任何文件
+"""
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+_tracking = threading.local()
+
+
+class HttpCache:
+    def __init__(self, cache_dir, max_bytes=50 * 1024 * 1024, read_only=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.written_path = os.path.join(cache_dir, "written.json")
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "revalidated": 0, "unchanged_by_hash": 0, "evictions": 0}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+        try:
+            with open(self.written_path, "r", encoding="utf-8") as f:
+                self.written = json.load(f)
+        except (OSError, ValueError):
+            self.written = {}
+
+    @staticmethod
+    def make_key(method, url, params=None):
+        params_text = json.dumps(sorted((str(k), str(v)) for k, v in dict(params or {}).items()))
+        return hashlib.sha1(f"{method.upper()} {url} {params_text}".encode("utf-8")).hexdigest()
+
+    def conditional_headers(self, key):
+        """缓存条目对应的条件请求头"""
+        with self.lock:
+            entry = self.index.get(key)
+        if not entry:
+            return {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def _body_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.gz")
+
+    def load_body(self, key):
+        """读取缓存的响应体，缓存损坏时返回None"""
+        try:
+            with gzip.open(self._body_path(key), "rb") as f:
+                body = f.read()
+        except OSError:
+            return None
+        with self.lock:
+            if key in self.index:
+                self.index[key]["last_used"] = time.time()
+        return body
+
+    def _entry_hash(self, key):
+        with self.lock:
+            return (self.index.get(key) or {}).get("hash")
+
+    def fill_not_modified(self, key, response):
+        """服务端返回304时用缓存的响应体补全 response（状态码改为200），返回是否补全成功
+
+        缓存文件丢失时不修改 response，调用方应去掉条件头重新请求
+        """
+        body = self.load_body(key)
+        if body is None:
+            return False
+        with self.lock:
+            self.stats["hits"] += 1
+            self.stats["revalidated"] += 1
+        _mark(key, self._entry_hash(key))
+        response.status_code = 200
+        response._content = body
+        return True
+
+    def store(self, key, response):
+        """保存200响应，返回响应体是否与缓存相同"""
+        body = response.content
+        digest = hashlib.sha1(body).hexdigest()
+        with self.lock:
+            entry = self.index.get(key)
+            unchanged = bool(entry and entry.get("hash") == digest)
+            if unchanged:
+                self.stats["hits"] += 1
+                self.stats["unchanged_by_hash"] += 1
+            else:
+                self.stats["misses"] += 1
+        if self.read_only:
+            _mark(key, digest)
+            return unchanged
+        # 响应体没变但缓存文件丢失时也要重新写入
+        if not unchanged or not os.path.exists(self._body_path(key)):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with gzip.open(self._body_path(key), "wb") as f:
+                f.write(body)
+        with self.lock:
+            self.index[key] = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "hash": digest,
+                "size": os.path.getsize(self._body_path(key)),
+                "last_used": time.time(),
+            }
+        _mark(key, digest)
+        self._evict()
+        return unchanged
+
+    def _evict(self):
+        with self.lock:
+            total = sum(e["size"] for e in self.index.values())
+            if total <= self.max_bytes:
+                return
+            for key, entry in sorted(self.index.items(), key=lambda item: item[1]["last_used"]):
+                if total <= self.max_bytes:
+                    break
+                total -= entry["size"]
+                del self.index[key]
+                self.stats["evictions"] += 1
+                try:
+                    os.remove(self._body_path(key))
+                except OSError:
+                    pass
+
+    def written_content_hash(self, book_id, response_hashes):
+        """本次响应与该书上次成功写入时完全一致时，返回当时的内容哈希，否则返回None"""
+        if not response_hashes:
+            return None
+        with self.lock:
+            entry = self.written.get(book_id)
+        if not entry or entry.get("responses") != response_hashes:
+            return None
+        return entry.get("content_hash")
+
+    def record_written(self, book_id, response_hashes, content_hash):
+        """该书所有输出都写入成功后调用，记录这次的响应哈希和内容哈希"""
+        if not response_hashes or not content_hash:
+            return
+        with self.lock:
+            self.written[book_id] = {"responses": response_hashes, "content_hash": content_hash}
+
+    def save(self):
+        """写回索引"""
+        if self.read_only:
+            return
+        with self.lock:
+            index = dict(self.index)
+            written = dict(self.written)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for path, data in ((self.index_path, index), (self.written_path, written)):
+            with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(f"{path}.tmp", path)
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.index)
+            stats["bytes"] = sum(e["size"] for e in self.index.values())
+        return stats
+
+
+def mark_untracked():
+    """当前请求的响应没有进入缓存（失败或不可缓存），本次记录不完整"""
+    _mark(None, None)
+
+
+def _mark(key, digest):
+    """记录一次响应的哈希；digest 为None表示响应没有进入缓存（失败或不可缓存）"""
+    if getattr(_tracking, "active", False):
+        if digest is None:
+            _tracking.complete = False
+        else:
+            _tracking.hashes[key] = digest
+
+
+def track_start():
+    """开始记录当前线程中各请求的响应哈希"""
+    _tracking.active = True
+    _tracking.complete = True
+    _tracking.hashes = {}
+
+
+def track_end():
+    """结束记录，返回 {缓存键: 响应哈希}；期间有请求没有进入缓存时返回None"""
+    _tracking.active = False
+    return _tracking.hashes if getattr(_tracking, "complete", False) else None
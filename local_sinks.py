@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""本地镜像输出 - 把渲染好的内容块同时写成 Markdown / JSONL 文件
+
+和 Notion 写入共用同一次抓取和渲染，每本书一个文件。
+输出目录中的 index.json 记录每本书的变化标记和内容哈希：
+标记没变的书不进入写入阶段，内容哈希没变的书只更新标记，不重写文件。
+"""
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+
+HEADING_LEVELS = {"heading_1": "##", "heading_2": "###", "heading_3": "####"}
+
+
+def block_text(block):
+    """Notion 块中的纯文本"""
+    data = block.get(block.get("type"), {})
+    return "".join(t.get("text", {}).get("content", "") for t in data.get("rich_text", []))
+
+
+class LocalSink(ABC):
+    """本地输出的基类 - 子类实现 render(job) 逐行产出文件内容"""
+
+    name = "local"
+    suffix = ""
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.index_path = os.path.join(out_dir, "index.json")
+        self.lock = threading.Lock()
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+        self.stats = {"written": 0, "unchanged": 0}
+
+    def _path(self, book_id):
+        return os.path.join(self.out_dir, f"{book_id}{self.suffix}")
+
+    def is_current(self, book_id, marker):
+        with self.lock:
+            entry = self.index.get(book_id)
+        return bool(entry and entry.get("marker") == marker and os.path.exists(self._path(book_id)))
+
+    def write(self, job):
+        """写入一本书 - 内容哈希没变时只更新标记"""
+        book_id = job["book_id"]
+        path = self._path(book_id)
+        with self.lock:
+            entry = self.index.get(book_id)
+        unchanged = bool(entry and entry.get("hash") == job["content_hash"] and os.path.exists(path))
+        if not unchanged:
+            os.makedirs(self.out_dir, exist_ok=True)
+            # 逐行写入临时文件后替换，中途失败不会留下半个文件
+            with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+                for line in self.render(job):
+                    f.write(line)
+            os.replace(f"{path}.tmp", path)
+        with self.lock:
+            self.stats["unchanged" if unchanged else "written"] += 1
+            self.index[book_id] = {"marker": job["marker"], "hash": job["content_hash"], "title": job["title"]}
+        return True
+
+    @abstractmethod
+    def render(self, job):
+        """逐行产出一本书的文件内容"""
+
+    def save(self):
+        with self.lock:
+            index = dict(self.index)
+        os.makedirs(self.out_dir, exist_ok=True)
+        with open(f"{self.index_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(f"{self.index_path}.tmp", self.index_path)
+        print(f"✅ {self.name} 镜像: 重写 {self.stats['written']} 本，内容未变化 {self.stats['unchanged']} 本 → {self.out_dir}")
+
+
+class MarkdownSink(LocalSink):
+    name = "markdown"
+    suffix = ".md"
+
+    def render(self, job):
+        yield f"# {job['title']}\n\n"
+        for block in job["children"]:
+            block_type = block.get("type")
+            text = block_text(block)
+            if block_type in HEADING_LEVELS:
+                yield f"{HEADING_LEVELS[block_type]} {text}\n\n"
+            elif block_type in ("quote", "callout"):
+                emoji = block.get("callout", {}).get("icon", {}).get("emoji", "")
+                lines = text.splitlines() or [""]
+                if emoji:
+                    lines[0] = f"{emoji} {lines[0]}"
+                yield "".join(f"> {line}\n" for line in lines) + "\n"
+            elif text:
+                yield f"{text}\n\n"
+
+
+class JsonlSink(LocalSink):
+    name = "jsonl"
+    suffix = ".jsonl"
+
+    def render(self, job):
+        chapter = None
+        for block in job["children"]:
+            block_type = block.get("type")
+            if block_type in HEADING_LEVELS:
+                chapter = block_text(block)
+                continue
+            if block_type not in ("quote", "callout", "paragraph"):
+                continue
+            record = {
+                "book_id": job["book_id"],
+                "title": job["title"],
+                "chapter": chapter,
+                "type": block_type,
+                "text": block_text(block),
+                "color": block.get(block_type, {}).get("color", "default"),
+            }
+            yield json.dumps(record, ensure_ascii=False) + "\n"
@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+"""会注入故障的本地 Notion API 替身 + 故障下吞吐测试
+
+替身实现了同步用到的 Notion 接口（数据库、页面、块），并按故障配置随机注入:
+429（带 Retry-After）、5xx、写入后丢失响应、超时、延迟尖刺、慢响应体。
+同一个服务也提供合成的微信读书只读接口（不注入故障）。
+
+    python notion_standin.py                      # 依次跑所有故障配置并输出对比表
+    python notion_standin.py --profiles throttled --books 50
+    python notion_standin.py --serve --profile flaky_5xx --port 8765
+
+每个配置在独立子进程里跑一次完整同步，统计:
+goodput（每分钟完成的书）、重复页面数、失败/浪费的请求数。
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# 故障配置 - 各项为每个请求命中的概率
+FAULT_PROFILES = {
+    "healthy": {},
+    "throttled": {"rate_429": 0.2, "retry_after": 1},
+    "flaky_5xx": {"rate_5xx": 0.1},
+    "lost_responses": {"rate_lost_response": 0.1},
+    "timeouts": {"rate_timeout": 0.05},
+    "latency_spikes": {"rate_spike": 0.1, "spike_seconds": 1.0},
+    "slow_bodies": {"rate_slow_body": 0.2, "slow_body_seconds": 0.5},
+}
+# 超时故障的挂起时间，需要大于子进程里的 NOTION_TIMEOUT
+TIMEOUT_HANG_SECONDS = 3.0
+CLIENT_TIMEOUT_SECONDS = 2.0
+
+DATABASE_SCHEMA = {
+    "BookName": "title", "BookId": "rich_text", "Author": "rich_text", "Sort": "number",
+    "Cover": "files", "Status": "select", "ReadingTime": "rich_text",
+    "BeginDate": "date", "EndDate": "date",
+}
+
+
+def _now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+class NotionState:
+    """替身的内存数据和统计"""
+
+    def __init__(self, profile, seed=0, books=20, highlights=20):
+        self.profile = profile
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.database = {
+            "id": "db",
+            "last_edited_time": _now(),
+            "properties": {name: {"type": t, t: {"options": []} if t == "select" else {}}
+                           for name, t in DATABASE_SCHEMA.items()},
+        }
+        self.pages = {}
+        self.children = {}
+        self.stats = {"requests": 0, "ok": 0, "faults": {}, "creates": 0, "methods": {}}
+        self.books = [{
+            "bookId": f"book{i}", "title": f"书籍{i}", "author": f"作者{i}", "cover": "https://example.com/c.jpg",
+            "sort": 1700000000 + i, "noteCount": highlights, "reviewCount": 0, "bookmarkCount": 0,
+        } for i in range(books)]
+        self.highlights = highlights
+
+    def fault(self, method):
+        """为当前请求抽一个故障，没有命中返回None"""
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["methods"][method] = self.stats["methods"].get(method, 0) + 1
+            for kind in ("429", "5xx", "lost_response", "timeout", "spike", "slow_body"):
+                if self.rng.random() < self.profile.get(f"rate_{kind}", 0):
+                    self.stats["faults"][kind] = self.stats["faults"].get(kind, 0) + 1
+                    return kind
+        return None
+
+    def duplicate_pages(self):
+        per_book = {}
+        for page in self.pages.values():
+            if page["archived"] or page["parent"].get("database_id") is None:
+                continue
+            book_id = _plain(page["properties"].get("BookId"))
+            per_book[book_id] = per_book.get(book_id, 0) + 1
+        return sum(n - 1 for n in per_book.values() if n > 1), len(per_book)
+
+
+def _plain(prop):
+    if not prop:
+        return ""
+    prop_type = next(iter(prop))
+    if prop_type in ("title", "rich_text"):
+        return "".join(t.get("text", {}).get("content", "") for t in prop[prop_type])
+    return prop[prop_type]
+
+
+def _render_property(value):
+    prop_type = next(iter(value))
+    data = value[prop_type]
+    if prop_type in ("title", "rich_text"):
+        data = [{**t, "plain_text": t.get("text", {}).get("content", "")} for t in data]
+    return {"type": prop_type, prop_type: data}
+
+
+def _render_page(page_id, page):
+    return {
+        "object": "page",
+        "id": page_id,
+        "created_time": page["created_time"],
+        "last_edited_time": page["last_edited_time"],
+        "archived": page["archived"],
+        "parent": page["parent"],
+        "properties": {name: _render_property(v) for name, v in page["properties"].items()},
+    }
+
+
+def _matches(page, condition):
+    if not condition:
+        return True
+    if "and" in condition:
+        return all(_matches(page, c) for c in condition["and"])
+    if "or" in condition:
+        return any(_matches(page, c) for c in condition["or"])
+    if condition.get("timestamp") == "last_edited_time":
+        after = condition["last_edited_time"].get("on_or_after") or condition["last_edited_time"].get("after")
+        return page["last_edited_time"] >= after
+    prop = condition.get("property")
+    for prop_type in ("rich_text", "title"):
+        if prop_type in condition:
+            return _plain(page["properties"].get(prop)) == condition[prop_type].get("equals")
+    if "select" in condition:
+        return (page["properties"].get(prop, {}).get("select") or {}).get("name") == condition["select"].get("equals")
+    if "number" in condition:
+        return page["properties"].get(prop, {}).get("number") == condition["number"].get("equals")
+    return True
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def log_message(self, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+    def _send(self, status, body, headers=None, slow=0.0):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if slow:
+            # 慢响应体 - 分块慢慢写
+            chunks = [data[i:i + 256] for i in range(0, len(data), 256)] or [b""]
+            for chunk in chunks:
+                self.wfile.write(chunk)
+                self.wfile.flush()
+                time.sleep(slow / len(chunks))
+        else:
+            self.wfile.write(data)
+
+    def _handle(self, method):
+        parsed = urlparse(self.path)
+        body = self._read_json() if method in ("POST", "PATCH") else {}
+        try:
+            if parsed.path.startswith("/v1/"):
+                self._handle_notion(method, parsed, body)
+            else:
+                self._send(200, self._weread(method, parsed, body))
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端已经超时断开
+            self.close_connection = True
+
+    do_GET = lambda self: self._handle("GET")
+    do_POST = lambda self: self._handle("POST")
+    do_PATCH = lambda self: self._handle("PATCH")
+    do_DELETE = lambda self: self._handle("DELETE")
+
+    def _handle_notion(self, method, parsed, body):
+        state = self.state
+        profile = state.profile
+        fault = state.fault(method)
+        if fault == "429":
+            return self._send(429, {"object": "error", "code": "rate_limited"},
+                              {"Retry-After": str(profile.get("retry_after", 1))})
+        if fault == "5xx":
+            return self._send(502, {"object": "error", "code": "internal_server_error"})
+        if fault == "spike":
+            time.sleep(profile.get("spike_seconds", 1.0))
+
+        status, result = self._notion(method, parsed.path[len("/v1"):], parse_qs(parsed.query), body)
+
+        if fault == "lost_response":
+            # 写入已经生效，但响应丢失
+            return self._send(504, {"object": "error", "code": "gateway_timeout"})
+        if fault == "timeout":
+            time.sleep(TIMEOUT_HANG_SECONDS)
+        with state.lock:
+            if status == 200:
+                state.stats["ok"] += 1
+        self._send(status, result, slow=profile.get("slow_body_seconds", 0.5) if fault == "slow_body" else 0.0)
+
+    def _notion(self, method, path, query, body):
+        state = self.state
+        parts = path.strip("/").split("/")
+        with state.lock:
+            if parts[0] == "databases" and len(parts) == 2:
+                if method == "PATCH":
+                    for name, prop in body.get("properties", {}).items():
+                        prop_type = next(iter(prop))
+                        state.database["properties"][name] = {"type": prop_type, prop_type: prop[prop_type]}
+                    state.database["last_edited_time"] = _now()
+                return 200, state.database
+            if parts[0] == "databases" and parts[2:] == ["query"]:
+                pages = [(pid, p) for pid, p in state.pages.items()
+                         if not p["archived"] and p["parent"].get("database_id") and _matches(p, body.get("filter"))]
+                for sort in reversed(body.get("sorts") or [{"timestamp": "created_time", "direction": "ascending"}]):
+                    if "timestamp" in sort:
+                        key = lambda item: item[1][sort["timestamp"]]
+                    else:
+                        key = lambda item: item[1]["properties"].get(sort["property"], {}).get("number") or 0
+                    pages.sort(key=key, reverse=sort.get("direction") == "descending")
+                start = int(body.get("start_cursor") or 0)
+                size = body.get("page_size", 100)
+                window = pages[start:start + size]
+                has_more = start + size < len(pages)
+                return 200, {"results": [_render_page(pid, p) for pid, p in window],
+                             "has_more": has_more, "next_cursor": str(start + size) if has_more else None}
+            if parts[0] == "pages" and len(parts) == 1 and method == "POST":
+                page_id = str(uuid.uuid4())
+                now = _now()
+                state.pages[page_id] = {"parent": body.get("parent", {}), "properties": body.get("properties", {}),
+                                        "created_time": now, "last_edited_time": now, "archived": False}
+                state.children[page_id] = [{**b, "id": str(uuid.uuid4())} for b in body.get("children", [])]
+                if "page_id" in body.get("parent", {}):
+                    title = body.get("properties", {}).get("title", {}).get("title", [])
+                    state.children.setdefault(body["parent"]["page_id"], []).append(
+                        {"type": "child_page", "id": page_id,
+                         "child_page": {"title": "".join(t["text"]["content"] for t in title)}})
+                state.stats["creates"] += 1
+                return 200, _render_page(page_id, state.pages[page_id])
+            if parts[0] == "pages" and len(parts) == 2:
+                page = state.pages.get(parts[1])
+                if page is None:
+                    return 404, {"object": "error", "code": "object_not_found"}
+                if method == "PATCH":
+                    page["properties"].update(body.get("properties", {}))
+                    if "archived" in body:
+                        page["archived"] = body["archived"]
+                    page["last_edited_time"] = _now()
+                return 200, _render_page(parts[1], page)
+            if parts[0] == "blocks" and parts[2:] == ["children"]:
+                block_id = parts[1]
+                if method == "PATCH":
+                    new_blocks = [{**b, "id": str(uuid.uuid4())} for b in body.get("children", [])]
+                    blocks = state.children.setdefault(block_id, [])
+                    position = len(blocks)
+                    if body.get("after"):
+                        position = next((i + 1 for i, b in enumerate(blocks) if b["id"] == body["after"]), None)
+                        if position is None:
+                            return 400, {"object": "error", "code": "validation_error"}
+                    blocks[position:position] = new_blocks
+                    if block_id in state.pages:
+                        state.pages[block_id]["last_edited_time"] = _now()
+                    return 200, {"results": new_blocks}
+                # 归档的子页面不再出现在父页面的子块中
+                blocks = [b for b in state.children.get(block_id, [])
+                          if not (b["type"] == "child_page" and state.pages[b["id"]]["archived"])]
+                start = int((query.get("start_cursor") or ["0"])[0])
+                size = int((query.get("page_size") or ["100"])[0])
+                has_more = start + size < len(blocks)
+                return 200, {"results": blocks[start:start + size], "has_more": has_more,
+                             "next_cursor": str(start + size) if has_more else None}
+            if parts[0] == "blocks" and len(parts) == 2 and method == "PATCH":
+                for blocks in state.children.values():
+                    for block in blocks:
+                        if block["id"] == parts[1]:
+                            block.update(body)
+                            return 200, block
+                return 404, {"object": "error", "code": "object_not_found"}
+            if parts[0] == "blocks" and len(parts) == 2 and method == "DELETE":
+                for blocks in state.children.values():
+                    for i, block in enumerate(blocks):
+                        if block["id"] == parts[1]:
+                            del blocks[i]
+                            return 200, {"id": parts[1], "archived": True}
+                return 404, {"object": "error", "code": "object_not_found"}
+        return 400, {"object": "error", "code": "invalid_request_url"}
+
+    def _weread(self, method, parsed, body):
+        """合成的微信读书只读接口"""
+        state = self.state
+        query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        if parsed.path.endswith("/api/user/notebook"):
+            return {"books": state.books}
+        if parsed.path.endswith("/web/book/bookmarklist"):
+            return {"updated": [{
+                "bookmarkId": f"{query['bookId']}_{i}", "chapterUid": i // 5 + 1, "chapterName": f"第{i // 5 + 1}章",
+                "markText": f"划线{i}", "style": i % 3, "colorStyle": i % 6, "range": f"{i * 10}-{i * 10 + 5}",
+            } for i in range(state.highlights)]}
+        if parsed.path.endswith("/web/review/list"):
+            return {"reviews": [], "hasMore": 0}
+        if parsed.path.endswith("/web/book/chapterInfos"):
+            return {"data": [{"updated": [{"chapterUid": i, "chapterIdx": i, "title": f"第{i}章"}
+                                          for i in range(1, state.highlights // 5 + 2)]}]}
+        if parsed.path.endswith("/book/readinfo"):
+            return {"markedStatus": 2, "readingTime": 3600}
+        return {}
+
+
+def serve(profile_name, port=0, seed=0, books=20, highlights=20):
+    """在后台线程中启动替身，返回 (server, state)"""
+    state = NotionState(FAULT_PROFILES[profile_name], seed, books, highlights)
+    handler = type("BoundHandler", (Handler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+def _run_sync_child(base_url, max_errors):
+    """子进程: 把微信读书地址指向替身后运行一次完整同步，最后一行输出JSON结果，返回同步的退出码"""
+    import weread_api
+    for name in ("WEREAD_URL", "WEREAD_NOTEBOOKS_URL", "WEREAD_BOOKMARKLIST_URL", "WEREAD_CHAPTER_INFO",
+                 "WEREAD_READ_INFO_URL", "WEREAD_REVIEW_LIST_URL", "WEREAD_I_BOOK_INFO"):
+        url = getattr(weread_api, name)
+        local = base_url + urlparse(url).path
+        weread_api.WEREAD_TIMEOUTS[local] = weread_api.WEREAD_TIMEOUTS.get(url, weread_api.WEREAD_DEFAULT_TIMEOUT)
+        setattr(weread_api, name, local)
+    start = time.monotonic()
+    result = weread_api.main("wr_skey=standin", "standin-token", "db", max_errors=max_errors)
+    code = weread_api.run_exit_code(result)
+    result = result or {}
+    result["elapsed"] = time.monotonic() - start
+    print(json.dumps(result))
+    return code
+
+
+def sync_once(base_url, state_dir, max_errors=1000, env=None):
+    """在子进程里对替身跑一次完整同步 - 返回 (退出码, 结果)，state_dir 为本地状态目录，多次运行可共用"""
+    env = {
+        **os.environ,
+        "NOTION_API_BASE": f"{base_url}/v1",
+        "NOTION_TIMEOUT": str(CLIENT_TIMEOUT_SECONDS),
+        "WEREAD_STATE_DIR": state_dir,
+        **(env or {}),
+    }
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", base_url, "--max-errors", str(max_errors)]
+    proc = subprocess.run(cmd, env=env, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        result = {}
+        print(proc.stdout[-2000:], proc.stderr[-2000:])
+    return proc.returncode, result
+
+
+def run_profile(profile_name, books, highlights, max_errors, seed=0):
+    """跑一个故障配置，返回统计结果"""
+    server, state = serve(profile_name, seed=seed, books=books, highlights=highlights)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    started = time.monotonic()
+    _, result = sync_once(base_url, tempfile.mkdtemp(prefix=f"standin_{profile_name}_"), max_errors)
+    elapsed = time.monotonic() - started
+    server.shutdown()
+    duplicates, distinct = state.duplicate_pages()
+    requests_total = state.stats["requests"]
+    return {
+        "profile": profile_name,
+        "books_done": result.get("success", 0),
+        "books_failed": result.get("error", 0),
+        "goodput_per_min": result.get("success", 0) / max(elapsed, 1e-9) * 60,
+        "elapsed": elapsed,
+        "notion_requests": requests_total,
+        "wasted_requests": requests_total - state.stats["ok"],
+        "duplicate_pages": duplicates,
+        "faults": state.stats["faults"],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="会注入故障的本地 Notion 替身和吞吐测试")
+    parser.add_argument("--profiles", nargs="+", choices=sorted(FAULT_PROFILES), default=list(FAULT_PROFILES))
+    parser.add_argument("--books", type=int, default=20)
+    parser.add_argument("--highlights", type=int, default=20, help="每本书的划线数")
+    parser.add_argument("--max-errors", type=int, default=1000, help="传给同步的 max_errors")
+    parser.add_argument("--output", help="结果写入JSON文件")
+    parser.add_argument("--serve", action="store_true", help="只启动替身，不运行测试")
+    parser.add_argument("--profile", choices=sorted(FAULT_PROFILES), default="healthy", help="--serve 时使用的配置")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--child", metavar="BASE_URL", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        return _run_sync_child(args.child, args.max_errors)
+
+    if args.serve:
+        server, _ = serve(args.profile, args.port, books=args.books, highlights=args.highlights)
+        print(f"🧪 Notion 替身已启动: http://127.0.0.1:{server.server_port}/v1  (配置: {args.profile})")
+        print(f"   NOTION_API_BASE=http://127.0.0.1:{server.server_port}/v1")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+        return 0
+
+    results = []
+    print(f"{'配置':16s} {'完成':>5s} {'失败':>5s} {'本/分钟':>9s} {'耗时s':>7s} {'请求':>6s} {'浪费':>6s} {'重复页':>6s}")
+    for name in args.profiles:
+        r = run_profile(name, args.books, args.highlights, args.max_errors)
+        results.append(r)
+        print(f"{name:16s} {r['books_done']:5d} {r['books_failed']:5d} {r['goodput_per_min']:9.1f} "
+              f"{r['elapsed']:7.1f} {r['notion_requests']:6d} {r['wasted_requests']:6d} {r['duplicate_pages']:6d}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""--profile 模式 - 在确定性分析器和采样器下运行同步
+
+输出目录中包含:
+- sync.pstats      cProfile 统计（主线程 + 所有工作线程合并），可用 snakeviz / pstats 查看
+- sync.collapsed   折叠栈，按墙钟时间采样，可直接喂给 flamegraph.pl / speedscope
+- stages.json      各顶层阶段的墙钟时间和 CPU 时间
+"""
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+
+
+class RunProfiler:
+    def __init__(self, output_dir, sample_interval=0.005):
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        self.lock = threading.Lock()
+        self.main_profile = cProfile.Profile()
+        self.thread_profiles = []
+        self.stacks = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample_loop, name="profiler-sampler", daemon=True)
+
+    def _thread_bootstrap(self, frame, event, arg):
+        """新线程的第一个事件 - 换成该线程自己的 cProfile"""
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self.lock:
+            self.thread_profiles.append(profile)
+        profile.enable()
+
+    def _sample_loop(self):
+        sampler_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.sample_interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def start(self):
+        # 先启动采样线程，避免它自己也被 cProfile 记录
+        self._sampler.start()
+        threading.setprofile(self._thread_bootstrap)
+        self.main_profile.enable()
+
+    def stop(self, stage_times=None):
+        self.main_profile.disable()
+        threading.setprofile(None)
+        self._stop.set()
+        self._sampler.join()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        stats = pstats.Stats(self.main_profile)
+        with self.lock:
+            thread_profiles = list(self.thread_profiles)
+        for profile in thread_profiles:
+            try:
+                stats.add(profile)
+            except TypeError:
+                # 线程没有产生任何调用记录
+                continue
+        pstats_path = os.path.join(self.output_dir, "sync.pstats")
+        stats.dump_stats(pstats_path)
+
+        collapsed_path = os.path.join(self.output_dir, "sync.collapsed")
+        with open(collapsed_path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+        stages_path = os.path.join(self.output_dir, "stages.json")
+        with open(stages_path, "w", encoding="utf-8") as f:
+            json.dump(stage_times or {}, f, ensure_ascii=False, indent=2)
+
+        print(f"🔬 性能分析结果已写入 {self.output_dir}/ (采样 {self.samples} 次)")
+        if stage_times:
+            print("🔬 各阶段 墙钟时间 / CPU时间:")
+            for name, times in stage_times.items():
+                print(f"   {name}: {times['wall_seconds']:.2f}s / {times['cpu_seconds']:.2f}s")
+        stats.sort_stats("cumulative").print_stats(15)
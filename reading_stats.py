@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""阅读统计的增量聚合
+
+每本书记录一份"贡献"（阅读时长、读完月份、划线数），总计按差值维护:
+书籍变化时减去旧贡献、加上新贡献，不需要重新扫描整个数据库。
+划线最多的书只在本地的每书贡献中排序，不产生请求。
+
+本地状态可能丢失（Actions 缓存会被淘汰），每次运行用书架和数据库索引为还没有贡献的书补种；
+书籍没有新笔记时阅读时长仍会增长: 书架条目的阅读进度标记（progress）变化时才由 update_progress 单独更新，
+每本书上次见到的标记保存在 progress 中。
+"""
+import json
+import os
+import threading
+
+
+class ReadingStats:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        self.books = data.get("books", {})
+        self.totals = data.get("totals") or self._empty_totals()
+        # 看板页面上各块的ID和上次写入的文本
+        self.dashboard = data.get("dashboard", {})
+        # {BookId: 上次处理过的书架阅读进度标记}
+        self.progress = data.get("progress", {})
+        self.changed = 0
+
+    @staticmethod
+    def _empty_totals():
+        return {"books": 0, "finished": 0, "reading_seconds": 0, "highlights": 0, "finished_by_month": {}}
+
+    def _apply(self, contribution, sign):
+        totals = self.totals
+        totals["books"] += sign
+        totals["reading_seconds"] += sign * contribution["reading_seconds"]
+        totals["highlights"] += sign * contribution["highlights"]
+        month = contribution.get("finished_month")
+        if month:
+            totals["finished"] += sign
+            by_month = totals["finished_by_month"]
+            by_month[month] = by_month.get(month, 0) + sign
+            if by_month[month] <= 0:
+                del by_month[month]
+
+    def record(self, book_id, title, reading_seconds, finished_month, highlights):
+        """记录一本书的最新数据，按与上次的差值更新总计"""
+        contribution = {
+            "title": title,
+            "reading_seconds": int(reading_seconds or 0),
+            "finished_month": finished_month,
+            "highlights": int(highlights or 0),
+        }
+        with self.lock:
+            self._replace(book_id, contribution)
+
+    def _replace(self, book_id, contribution):
+        old = self.books.get(book_id)
+        if old == contribution:
+            return
+        if old:
+            self._apply(old, -1)
+        self._apply(contribution, 1)
+        self.books[book_id] = contribution
+        self.changed += 1
+
+    def seed(self, book_id, title, reading_seconds, finished_month, highlights):
+        """还没有贡献的书按已知数据补上，已有的不动"""
+        with self.lock:
+            if book_id in self.books:
+                return False
+            self._replace(book_id, {
+                "title": title,
+                "reading_seconds": int(reading_seconds or 0),
+                "finished_month": finished_month,
+                "highlights": int(highlights or 0),
+            })
+        return True
+
+    def update_progress(self, book_id, title, reading_seconds, finished_month):
+        """只更新阅读时长和读完月份，划线数沿用上次记录的"""
+        with self.lock:
+            old = self.books.get(book_id) or {}
+            self._replace(book_id, {
+                "title": title,
+                "reading_seconds": int(reading_seconds or 0),
+                "finished_month": finished_month,
+                "highlights": old.get("highlights", 0),
+            })
+
+    def progress_changed(self, book_id, marker):
+        """书架上的阅读进度标记与上次处理时不同；第一次见到的书只记下标记，不算变化"""
+        if not marker:
+            return False
+        with self.lock:
+            old = self.progress.get(book_id)
+            if old is None:
+                self.progress[book_id] = marker
+                return False
+            return old != marker
+
+    def mark_progress(self, book_id, marker):
+        if not marker:
+            return
+        with self.lock:
+            self.progress[book_id] = marker
+
+    def top_books(self, limit=10):
+        with self.lock:
+            items = [(c["highlights"], c["title"]) for c in self.books.values() if c["highlights"]]
+        return sorted(items, key=lambda item: -item[0])[:limit]
+
+    def summary_lines(self, months=24, top=10):
+        """看板各段文本: (总计, 每月读完, 划线最多的书)"""
+        with self.lock:
+            totals = json.loads(json.dumps(self.totals))
+        average = totals["highlights"] / totals["books"] if totals["books"] else 0
+        overview = [
+            f"书籍 {totals['books']} 本，读完 {totals['finished']} 本",
+            f"总阅读时长 {totals['reading_seconds'] / 3600:.1f} 小时",
+            f"划线 {totals['highlights']} 条，平均每本 {average:.1f} 条",
+        ]
+        by_month = sorted(totals["finished_by_month"].items(), reverse=True)[:months]
+        monthly = [f"{month}: {count} 本" for month, count in by_month] or ["暂无"]
+        ranking = [f"{i}. {title} — {count} 条" for i, (count, title) in enumerate(self.top_books(top), 1)] or ["暂无"]
+        return overview, monthly, ranking
+
+    def save(self):
+        with self.lock:
+            data = {"books": self.books, "totals": self.totals, "dashboard": self.dashboard,
+                    "progress": self.progress}
+            text = json.dumps(data, ensure_ascii=False)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(f"{self.path}.tmp", "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(f"{self.path}.tmp", self.path)
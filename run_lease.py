@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""运行级租约 - 保证同一个数据库同时只有一个同步在写
+
+租约记录持有者和到期时间。持有期间后台线程每 ttl/3 续期一次；
+进程异常退出时不会释放，到期后其他运行可以接管，不会永久锁死。
+
+- FileLease: 本地锁文件，适合同一台机器上的多次运行
+- NotionLease: 数据库中的一行锁页面（BookId 为 LEASE_BOOK_ID），适合不同机器（如 GitHub Actions）
+
+Notion 没有原子的比较并交换，NotionLease 写入后等待 settle 秒再读回确认持有者仍是自己，
+两个运行几乎同时写入时只有后写的一方能确认成功。
+"""
+import json
+import os
+from abc import ABC, abstractmethod
+import socket
+import threading
+import time
+import uuid
+
+LEASE_BOOK_ID = "__weread_sync_lease__"
+
+
+def make_owner():
+    """持有者标识: 主机:进程号:随机串，GitHub Actions 中带上 run_id"""
+    run_id = os.environ.get("GITHUB_RUN_ID")
+    parts = [socket.gethostname(), str(os.getpid()), uuid.uuid4().hex[:8]]
+    if run_id:
+        parts.insert(0, f"gh{run_id}")
+    return ":".join(parts)
+
+
+class LeaseBusy(Exception):
+    """租约被其他运行持有"""
+
+    def __init__(self, holder, expires_at):
+        self.holder = holder
+        self.expires_at = expires_at
+        super().__init__(f"租约被 {holder} 持有，{max(0, int(expires_at - time.time()))} 秒后到期")
+
+
+class RunLease(ABC):
+    """租约基类 - 子类实现 _read() -> (持有者, 到期时间) 或 None / _write(持有者, 到期时间) / _clear()"""
+
+    name = "lease"
+
+    def __init__(self, ttl=600, owner=None, poll_interval=15):
+        self.ttl = ttl
+        self.owner = owner or make_owner()
+        self.poll_interval = poll_interval
+        self.held = False
+        self.expires_at = 0.0
+        # 租约被接管或续期失败到过期时置位，持有者应停止写入
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @abstractmethod
+    def _read(self):
+        ...
+
+    @abstractmethod
+    def _write(self, owner, expires_at):
+        ...
+
+    @abstractmethod
+    def _clear(self):
+        ...
+
+    def _try_acquire(self):
+        current = self._read()
+        if current and current[0] != self.owner and current[1] > time.time():
+            raise LeaseBusy(*current)
+        self._write(self.owner, time.time() + self.ttl)
+        return self._confirm()
+
+    def _confirm(self):
+        current = self._read()
+        if not current or current[0] != self.owner:
+            raise LeaseBusy(*(current or ("未知", time.time() + self.ttl)))
+        return True
+
+    def acquire(self, wait_seconds=0):
+        """获取租约 - 被占用时最多等待 wait_seconds 秒，仍被占用则抛出 LeaseBusy"""
+        deadline = time.time() + wait_seconds
+        while True:
+            try:
+                self._try_acquire()
+                break
+            except LeaseBusy as busy:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise
+                print(f"⏳ {busy}，等待中")
+                time.sleep(min(self.poll_interval, remaining, max(1, busy.expires_at - time.time())))
+        self.held = True
+        self.expires_at = time.time() + self.ttl
+        self.lost.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._heartbeat, name=f"{self.name}-heartbeat", daemon=True)
+        self._thread.start()
+        print(f"🔒 已获取{self.name}租约: {self.owner}，有效期 {self.ttl} 秒")
+        return self
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                current = self._read()
+                if current and current[0] != self.owner:
+                    print(f"⚠️ 租约已被 {current[0]} 接管")
+                    self.lost.set()
+                    return
+                expires_at = time.time() + self.ttl
+                self._write(self.owner, expires_at)
+                self.expires_at = expires_at
+            except Exception as e:
+                # 续期失败不终止同步，租约到期前还有两次机会
+                print(f"⚠️ 租约续期失败: {e}")
+                if time.time() >= self.expires_at:
+                    print("⚠️ 租约已过期")
+                    self.lost.set()
+                    return
+
+    def release(self):
+        if not self.held:
+            return
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.held = False
+        try:
+            current = self._read()
+            if current and current[0] == self.owner:
+                self._clear()
+                print("🔓 已释放租约")
+        except Exception as e:
+            print(f"⚠️ 释放租约失败，{self.ttl} 秒后自动到期: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class FileLease(RunLease):
+    """本地锁文件 - 创建用 O_EXCL 保证只有一个进程成功，过期后原子替换接管"""
+
+    name = "file"
+
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+
+    def _read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data["owner"], float(data["expires_at"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write(self, owner, expires_at):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"owner": owner, "expires_at": expires_at}, f)
+        os.replace(tmp_path, self.path)
+
+    def _clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def _try_acquire(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # 已有锁文件: 未过期则被占用，过期则接管
+            return super()._try_acquire()
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"owner": self.owner, "expires_at": time.time() + self.ttl}, f)
+        return True
+
+
+class NotionLease(RunLease):
+    """数据库中的锁页面 - 租约写在锁页面的 value_property（rich_text）中，格式为 持有者|到期时间
+
+    request(method, endpoint, payload) 为已绑定 Token 的 Notion 请求函数，失败返回None
+    """
+
+    name = "notion"
+
+    def __init__(self, database_id, request, value_property, settle=3, **kwargs):
+        super().__init__(**kwargs)
+        self.database_id = database_id
+        self.request = request
+        self.value_property = value_property
+        self.settle = settle
+        self.page_id = None
+
+    def _call(self, method, endpoint, payload=None):
+        response = self.request(method, endpoint, payload)
+        if response is None:
+            raise RuntimeError(f"Notion请求失败: {method} {endpoint}")
+        return response
+
+    def _lease_properties(self, value):
+        return {self.value_property: {"rich_text": [{"type": "text", "text": {"content": value}}] if value else []}}
+
+    def _parse(self, page):
+        prop = page.get("properties", {}).get(self.value_property) or {}
+        value = "".join(t.get("plain_text", "") for t in prop.get("rich_text", []))
+        if "|" not in value:
+            return None
+        owner, expires_at = value.rsplit("|", 1)
+        try:
+            return owner, float(expires_at)
+        except ValueError:
+            return None
+
+    def _find_page(self):
+        """找到锁页面，没有时创建；并发创建出多个时保留最早的一个"""
+        payload = {
+            "page_size": 100,
+            "filter": {"property": "BookId", "rich_text": {"equals": LEASE_BOOK_ID}},
+            "sorts": [{"timestamp": "created_time", "direction": "ascending"}],
+        }
+        pages = self._call("POST", f"/databases/{self.database_id}/query", payload).get("results", [])
+        if pages:
+            return pages[0]["id"]
+        properties = {
+            "BookName": {"title": [{"text": {"content": "🔒 同步租约（请勿删除）"}}]},
+            "BookId": {"rich_text": [{"text": {"content": LEASE_BOOK_ID}}]},
+        }
+        created = self._call("POST", "/pages", {"parent": {"database_id": self.database_id},
+                                                "properties": properties})
+        pages = self._call("POST", f"/databases/{self.database_id}/query", payload).get("results", [])
+        for page in pages[1:]:
+            if page["id"] == created.get("id"):
+                self.request("PATCH", f"/pages/{page['id']}", {"archived": True})
+        return pages[0]["id"] if pages else created["id"]
+
+    def _read(self):
+        if self.page_id is None:
+            self.page_id = self._find_page()
+        return self._parse(self._call("GET", f"/pages/{self.page_id}"))
+
+    def _write(self, owner, expires_at):
+        self._call("PATCH", f"/pages/{self.page_id}",
+                   {"properties": self._lease_properties(f"{owner}|{expires_at:.0f}")})
+
+    def _clear(self):
+        self._call("PATCH", f"/pages/{self.page_id}", {"properties": self._lease_properties("")})
+
+    def _confirm(self):
+        # 等其他几乎同时写入的运行落盘后再读回，最后写入的一方获胜
+        time.sleep(self.settle)
+        return super()._confirm()
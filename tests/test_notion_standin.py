@@ -0,0 +1,76 @@
+"""用会注入故障的 Notion 替身跑完整同步: 不产生重复页面、空跑不写入、退出码正确"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import notion_standin  # noqa: E402
+from run_lease import FileLease  # noqa: E402
+
+BOOKS = 4
+HIGHLIGHTS = 6
+
+
+@pytest.fixture
+def standin():
+    servers = []
+
+    def start(profile="healthy", seed=0):
+        server, state = notion_standin.serve(profile, seed=seed, books=BOOKS, highlights=HIGHLIGHTS)
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_port}", state
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+@pytest.mark.parametrize("profile", ["healthy", "flaky_5xx", "lost_responses"])
+def test_no_duplicate_pages(standin, tmp_path, profile):
+    base_url, state = standin(profile)
+    code, result = notion_standin.sync_once(base_url, str(tmp_path))
+    duplicates, distinct = state.duplicate_pages()
+    assert duplicates == 0
+    # 失败的书下次运行补上，仍然不会重复创建
+    if code != 0:
+        notion_standin.sync_once(base_url, str(tmp_path))
+        duplicates, distinct = state.duplicate_pages()
+        assert duplicates == 0
+    assert distinct == BOOKS
+
+
+def test_idle_rerun_sends_no_writes(standin, tmp_path):
+    base_url, state = standin()
+    code, result = notion_standin.sync_once(base_url, str(tmp_path))
+    assert code == 0
+    assert result["success"] == BOOKS
+    before = dict(state.stats["methods"])
+    code, result = notion_standin.sync_once(base_url, str(tmp_path))
+    assert code == 0
+    assert result["success"] == 0
+    writes = {method: state.stats["methods"].get(method, 0) - before.get(method, 0)
+              for method in ("PATCH", "DELETE")}
+    assert writes == {"PATCH": 0, "DELETE": 0}
+    assert state.stats["creates"] == BOOKS
+
+
+def test_exit_code_when_notion_is_down(standin, tmp_path):
+    base_url, state = standin()
+    state.profile = {"rate_5xx": 1.0}
+    code, result = notion_standin.sync_once(base_url, str(tmp_path), env={"NOTION_MAX_RETRIES": "0"})
+    assert code == 1
+
+
+def test_exit_code_when_lease_is_busy(standin, tmp_path):
+    base_url, state = standin()
+    env = {**os.environ, "NOTION_API_BASE": f"{base_url}/v1", "WEREAD_STATE_DIR": str(tmp_path)}
+    cmd = [sys.executable, os.path.join(ROOT, "weread_api.py"), "dedupe", "standin-token", "db", "--lease", "file"]
+    with FileLease(str(tmp_path / "sync.lease"), ttl=600, owner="other-run").acquire():
+        busy = subprocess.run(cmd, env=env, capture_output=True, text=True, cwd=ROOT)
+    assert busy.returncode == 4
+    free = subprocess.run(cmd, env=env, capture_output=True, text=True, cwd=ROOT)
+    assert free.returncode == 0
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""结构化追踪 - 同步运行 / 每本书 / 每个HTTP请求 一个 span，写入 JSONL
+
+每行一个 span: {"span_id", "parent_id", "name", "start", "duration", "thread", "attrs"}
+未启用时所有调用都是空操作。转换成 Chrome trace（chrome://tracing、Perfetto 可打开）:
+
+    python tracing.py trace.jsonl trace.json
+"""
+import itertools
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# span 属性中文本字段的最大长度，超出截断
+MAX_ATTR_CHARS = 500
+
+
+class Span:
+    __slots__ = ("tracer", "span_id", "parent_id", "name", "start", "attrs")
+
+    def __init__(self, tracer, span_id, parent_id, name, attrs):
+        self.tracer = tracer
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time()
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def end(self, **attrs):
+        self.attrs.update(attrs)
+        self.tracer._write(self)
+
+
+class Tracer:
+    def __init__(self):
+        self.file = None
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.local = threading.local()
+
+    @property
+    def enabled(self):
+        return self.file is not None
+
+    def open(self, path):
+        self.file = open(path, "a", encoding="utf-8")
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+    def current(self):
+        stack = getattr(self.local, "stack", None)
+        return stack[-1] if stack else None
+
+    def start_span(self, name, parent=None, **attrs):
+        """开始一个 span；parent 可以是 Span 或 span_id，默认是当前线程的活动 span"""
+        if not self.enabled:
+            return None
+        if parent is None:
+            parent = self.current()
+        parent_id = parent.span_id if isinstance(parent, Span) else parent
+        return Span(self, next(self.ids), parent_id, name, attrs)
+
+    @contextmanager
+    def activate(self, span):
+        """在当前线程中把 span 设为父 span"""
+        if span is None:
+            yield None
+            return
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            stack.pop()
+
+    @contextmanager
+    def span(self, name, parent=None, **attrs):
+        """开始并激活一个 span，退出时结束；异常记录到 error 属性"""
+        span = self.start_span(name, parent, **attrs)
+        if span is None:
+            yield None
+            return
+        with self.activate(span):
+            try:
+                yield span
+            except Exception as e:
+                span.set(error=truncate(str(e)))
+                raise
+            finally:
+                span.end()
+
+    def _write(self, span):
+        record = {
+            "span_id": span.span_id,
+            "parent_id": span.parent_id,
+            "name": span.name,
+            "start": round(span.start, 6),
+            "duration": round(time.time() - span.start, 6),
+            "thread": threading.current_thread().name,
+            "attrs": span.attrs,
+        }
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self.lock:
+            if self.file:
+                self.file.write(line + "\n")
+
+
+def truncate(text, limit=MAX_ATTR_CHARS):
+    if text is None:
+        return None
+    text = str(text)
+    return text if len(text) <= limit else f"{text[:limit]}...(+{len(text) - limit})"
+
+
+tracer = Tracer()
+
+
+def to_chrome_trace(jsonl_path, output_path):
+    """JSONL span 转成 Chrome trace 事件格式"""
+    events = []
+    threads = {}
+    with open(jsonl_path, "r", encoding="utf-8") as f:
+        for line in f:
+            span = json.loads(line)
+            tid = threads.setdefault(span["thread"], len(threads) + 1)
+            events.append({
+                "name": span["name"],
+                "cat": span["name"],
+                "ph": "X",
+                "ts": span["start"] * 1e6,
+                "dur": span["duration"] * 1e6,
+                "pid": 1,
+                "tid": tid,
+                "args": {**span["attrs"], "span_id": span["span_id"], "parent_id": span["parent_id"]},
+            })
+    for name, tid in threads.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": name}})
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events}, f, ensure_ascii=False)
+    print(f"✅ 已转换 {len(events)} 个事件: {output_path}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("用法: python tracing.py trace.jsonl trace.json")
+        sys.exit(1)
+    to_chrome_trace(sys.argv[1], sys.argv[2])
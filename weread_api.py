@@ -1,13 +1,37 @@
 #!/usr/bin/env python3
 import argparse
+import difflib
+import gzip
+import hashlib
+import heapq
 import json
 import logging
 import os
+import queue
+import random
 import re
+import sys
+import threading
 import time
 import requests
+from collections import deque
+from contextlib import contextmanager
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, wait
 from urllib.parse import parse_qs
-from datetime import datetime
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import http_cache
+try:
+    # 可选的更快的JSON编码后端
+    import orjson
+except ImportError:
+    orjson = None
+from local_sinks import JsonlSink, MarkdownSink
+from reading_stats import ReadingStats
+from run_lease import LEASE_BOOK_ID, FileLease, LeaseBusy, NotionLease
+from tracing import tracer, truncate
 
 WEREAD_URL = "https://weread.qq.com/"
 WEREAD_NOTEBOOKS_URL = "https://weread.qq.com/api/user/notebook"
@@ -16,10 +40,323 @@ WEREAD_CHAPTER_INFO = "https://weread.qq.com/web/book/chapterInfos"
 WEREAD_READ_INFO_URL = "https://weread.qq.com/book/readinfo"
 WEREAD_REVIEW_LIST_URL = "https://weread.qq.com/web/review/list"
 WEREAD_BOOK_INFO = "https://weread.qq.com/api/book/info"
+WEREAD_I_BOOK_INFO = "https://i.weread.qq.com/book/info"
+
+# 各接口的请求超时（秒）
+WEREAD_TIMEOUTS = {
+    WEREAD_URL: 10,
+    WEREAD_NOTEBOOKS_URL: 30,
+    WEREAD_BOOKMARKLIST_URL: 30,
+    WEREAD_CHAPTER_INFO: 20,
+    WEREAD_READ_INFO_URL: 15,
+    WEREAD_REVIEW_LIST_URL: 30,
+    WEREAD_I_BOOK_INFO: 15,
+}
+WEREAD_DEFAULT_TIMEOUT = 20
+# 笔记列表每页条数
+WEREAD_REVIEW_PAGE_SIZE = 100
+
+# 重试策略：指数退避 + 随机抖动
+WEREAD_MAX_RETRIES = int(os.environ.get("WEREAD_MAX_RETRIES", 3))
+WEREAD_BACKOFF_BASE = 1.0
+WEREAD_BACKOFF_MAX = 30.0
+# 服务端限流/繁忙时返回的errCode，可通过环境变量调整，如 "-1,-2013"
+WEREAD_THROTTLE_ERRCODES = {
+    int(code) for code in os.environ.get("WEREAD_THROTTLE_ERRCODES", "-1").split(",") if code.strip()
+}
+
+# 本地状态目录 - 存放创建日志等运行间需要保留的数据
+SYNC_STATE_DIR = os.environ.get("WEREAD_STATE_DIR", ".weread_sync")
+CREATE_JOURNAL_FILE = os.path.join(SYNC_STATE_DIR, "create_journal.json")
+CHAPTER_PAGES_FILE = os.path.join(SYNC_STATE_DIR, "chapter_pages.json")
+SNAPSHOT_DIR = os.path.join(SYNC_STATE_DIR, "snapshots")
+HTTP_CACHE_DIR = os.path.join(SYNC_STATE_DIR, "http_cache")
+READING_STATS_FILE = os.path.join(SYNC_STATE_DIR, "reading_stats.json")
+# 阅读统计看板页面ID，不设置时只在本地维护统计
+DASHBOARD_PAGE_ID = os.environ.get("WEREAD_DASHBOARD_PAGE_ID")
+PAGE_BLOCKS_FILE = os.path.join(SYNC_STATE_DIR, "page_blocks.json")
+# 持久化的数据库索引 - 启动时只查询上次之后编辑过的页面，定期全量扫描以发现删除
+NOTION_INDEX_FILE = os.path.join(SYNC_STATE_DIR, "notion_index.json")
+NOTION_INDEX_FULL_SCAN_SECONDS = float(os.environ.get("WEREAD_INDEX_FULL_SCAN_DAYS", 7)) * 86400
+# 上次完整同步成功时书架的摘要，probe 用来判断是否需要同步
+SHELF_DIGEST_FILE = os.path.join(SYNC_STATE_DIR, "shelf_digest")
+# probe 发现没有变化时的退出码
+PROBE_UNCHANGED_EXIT = 3
+# 运行级租约 - 同一数据库同时只允许一个写入的运行，租约过期时间(秒)和被占用时的退出码
+LEASE_TTL = int(os.environ.get("WEREAD_LEASE_TTL", 600))
+LEASE_FILE = os.path.join(SYNC_STATE_DIR, "sync.lease")
+LEASE_BUSY_EXIT = 4
+# 估算运行时间用: Notion 平均限流(请求/秒) 和 WeRead 单个请求的平均耗时(秒)
+NOTION_RATE_LIMIT = float(os.environ.get("NOTION_RATE_LIMIT", 3))
+WEREAD_REQUEST_SECONDS = 0.5
+# WeRead 响应缓存上限(MB)，0表示不使用缓存
+HTTP_CACHE_MAX_MB = int(os.environ.get("WEREAD_HTTP_CACHE_MB", 50))
+# 书籍摘要属性 - 记录笔记数、更新标记和内容哈希，用于判断书籍是否变化
+DIGEST_PROPERTY = os.environ.get("WEREAD_DIGEST_PROPERTY", "SyncDigest")
+# 划线数达到该值的书按章节拆分子页面，0表示不拆分
+CHAPTER_PAGES_THRESHOLD = int(os.environ.get("WEREAD_CHAPTER_PAGES_THRESHOLD", 0))
+NOTION_CREATE_RETRIES = 3
+# Notion API 地址和超时，可指向本地替身做故障测试
+NOTION_API_BASE = os.environ.get("NOTION_API_BASE", "https://api.notion.com/v1")
+NOTION_TIMEOUT = float(os.environ.get("NOTION_TIMEOUT", 30))
+# Notion 请求重试: 429 和 502/503 总是重试；500、504 和网络异常只重试幂等请求
+NOTION_MAX_RETRIES = int(os.environ.get("NOTION_MAX_RETRIES", 4))
+NOTION_BACKOFF_MAX = 30.0
+# Notion 请求失败时输出的载荷/响应最大长度
+NOTION_ERROR_PAYLOAD_CHARS = 2000
+# 追加子块: 每次请求最多100个块，请求体不超过该字节数
+NOTION_CHILDREN_LIMIT = 100
+NOTION_PAYLOAD_BYTES = 450 * 1024
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# 运行指标 - 同步结束时统一输出
+RUN_METRICS = {}
+_metrics_lock = threading.Lock()
+
+def incr_metric(name, value=1):
+    """累加运行指标"""
+    with _metrics_lock:
+        RUN_METRICS[name] = RUN_METRICS.get(name, 0) + value
+
+def print_run_metrics():
+    """输出本次运行的指标"""
+    with _metrics_lock:
+        metrics = dict(RUN_METRICS)
+    metrics["weread_circuit"] = weread_breaker.snapshot()
+    if weread_http_cache is not None:
+        metrics["weread_http_cache"] = weread_http_cache.snapshot()
+    metrics["notion_paced_seconds"] = round(notion_pacer.waited_seconds, 2)
+    print("📊 运行指标:")
+    for name in sorted(metrics):
+        print(f"   {name}: {metrics[name]}")
+
+# 各顶层阶段的墙钟时间和CPU时间
+STAGE_TIMES = {}
+
+def add_stage_time(name, wall, cpu):
+    with _metrics_lock:
+        times = STAGE_TIMES.setdefault(name, {"wall_seconds": 0.0, "cpu_seconds": 0.0})
+        times["wall_seconds"] += wall
+        times["cpu_seconds"] += cpu
+
+@contextmanager
+def stage_timer(name):
+    """记录当前线程中一个阶段的墙钟时间和CPU时间"""
+    wall_start, cpu_start = time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        add_stage_time(name, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+
+class CircuitBreaker:
+    """熔断器 - 错误率升高时放慢整个抓取阶段，而不是继续猛打服务端或直接退出
+
+    closed: 正常请求
+    open: 错误率超过阈值，每个请求前等待 delay 秒，持续失败时 delay 翻倍
+    half_open: 冷却结束后试探，成功则恢复 closed，失败重新 open
+    """
+
+    def __init__(self, window=20, min_calls=5, error_threshold=0.5,
+                 base_delay=2.0, max_delay=60.0, cooldown=30.0):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_threshold = error_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.outcomes = deque(maxlen=window)
+        self.state = "closed"
+        self.delay = 0.0
+        self.opened_at = 0.0
+        self.open_count = 0
+        self.throttled_seconds = 0.0
+
+    def _error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def _open(self, delay):
+        self.state = "open"
+        self.delay = min(delay, self.max_delay)
+        self.opened_at = time.monotonic()
+
+    def before_request(self):
+        """请求前调用，熔断打开时在这里放慢节奏"""
+        with self.lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = "half_open"
+            delay = self.delay if self.state != "closed" else 0.0
+            self.throttled_seconds += delay
+        if delay > 0:
+            time.sleep(delay)
+
+    def record(self, ok):
+        """记录一次请求结果"""
+        with self.lock:
+            self.outcomes.append(ok)
+            if self.state == "half_open":
+                if ok:
+                    print("🟢 WeRead 熔断恢复")
+                    self.state = "closed"
+                    self.delay = 0.0
+                    self.outcomes.clear()
+                else:
+                    self._open(self.delay * 2)
+            elif self.state == "open":
+                if not ok:
+                    self._open(self.delay * 2)
+            elif len(self.outcomes) >= self.min_calls and self._error_rate() >= self.error_threshold:
+                self.open_count += 1
+                self._open(self.base_delay)
+                print(f"🟠 WeRead 错误率 {self._error_rate():.0%}，熔断打开，请求间隔 {self.delay:.1f}s")
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "state": self.state,
+                "delay": round(self.delay, 2),
+                "error_rate": round(self._error_rate(), 3),
+                "open_count": self.open_count,
+                "throttled_seconds": round(self.throttled_seconds, 2),
+            }
+
+weread_breaker = CircuitBreaker()
+
+class RateLimiter:
+    """所有线程共享的请求节奏 - 每个请求占一个 1/rate 秒的时间槽，收到 Retry-After 时整体暂停"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+        self.waited_seconds = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+            delay = slot - now
+            self.waited_seconds += delay
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """服务端要求等待时，之后的请求都排到 seconds 秒之后"""
+        with self.lock:
+            self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+notion_pacer = RateLimiter(NOTION_RATE_LIMIT)
+weread_http_cache = None
+
+def init_http_cache(max_mb=HTTP_CACHE_MAX_MB, read_only=False):
+    """启用 WeRead 响应缓存 - read_only 时只读取已有缓存，不写入响应体和索引"""
+    global weread_http_cache
+    weread_http_cache = (http_cache.HttpCache(HTTP_CACHE_DIR, max_mb * 1024 * 1024, read_only=read_only)
+                         if max_mb > 0 else None)
+    return weread_http_cache
+
+def _cache_key(method, url, kwargs):
+    """读接口的缓存键 - GET 和章节信息的 POST 都是只读请求"""
+    if method.upper() != "GET" and url != WEREAD_CHAPTER_INFO:
+        return None
+    params = dict(kwargs.get("params") or {})
+    if kwargs.get("json") is not None:
+        params["__body__"] = json.dumps(kwargs["json"], sort_keys=True)
+    return http_cache.HttpCache.make_key(method, url, params)
+
+def _is_error_body(response):
+    """带非0 errCode 的响应不缓存"""
+    if b'"errCode"' not in response.content:
+        return False
+    try:
+        data = response.json()
+    except ValueError:
+        return True
+    return isinstance(data, dict) and data.get("errCode") not in (None, 0)
+
+def _backoff_delay(attempt, retry_after=None):
+    """指数退避 + full jitter；服务端给出 Retry-After 时优先使用"""
+    if retry_after:
+        try:
+            return min(float(retry_after), WEREAD_BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(WEREAD_BACKOFF_MAX, WEREAD_BACKOFF_BASE * (2 ** attempt)))
+
+def _is_throttled(response):
+    """判断响应是否属于可重试的失败：5xx、429 或限流errCode"""
+    if response.status_code == 429 or response.status_code >= 500:
+        return True
+    # 只有带 errCode 的响应才需要解析，正常的大响应不在这里重复解析
+    if response.status_code == 200 and b'"errCode"' in response.content:
+        try:
+            data = response.json()
+        except ValueError:
+            return False
+        return isinstance(data, dict) and data.get("errCode") in WEREAD_THROTTLE_ERRCODES
+    return False
+
+def weread_request(session, method, url, **kwargs):
+    """WeRead 统一请求入口 - 按接口超时、退避重试、熔断
+
+    返回最后一次的 Response；全部尝试都抛异常时返回 None
+    """
+    kwargs.setdefault("timeout", WEREAD_TIMEOUTS.get(url, WEREAD_DEFAULT_TIMEOUT))
+    cache = weread_http_cache
+    cache_key = _cache_key(method, url, kwargs) if cache is not None else None
+    plain_headers = kwargs.get("headers")
+    if cache_key:
+        kwargs["headers"] = {**(plain_headers or {}), **cache.conditional_headers(cache_key)}
+    span = tracer.start_span("weread.http", method=method.upper(), endpoint=url)
+    response = None
+    for attempt in range(WEREAD_MAX_RETRIES + 1):
+        if attempt > 0:
+            incr_metric("weread_retries")
+            retry_after = response.headers.get("Retry-After") if response is not None else None
+            time.sleep(_backoff_delay(attempt, retry_after))
+        weread_breaker.before_request()
+        incr_metric("weread_requests")
+        if span:
+            span.set(retries=attempt)
+        revalidated = False
+        try:
+            response = session.request(method, url, **kwargs)
+            if cache_key and response.status_code == 304:
+                revalidated = cache.fill_not_modified(cache_key, response)
+                if not revalidated:
+                    # 缓存文件丢失: 立即去掉条件头重新请求（不算重试），新的响应照常写入缓存
+                    kwargs["headers"] = plain_headers
+                    incr_metric("weread_requests")
+                    response = session.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            print(f"⚠️ WeRead 请求异常 ({attempt + 1}/{WEREAD_MAX_RETRIES + 1}): {url} - {e}")
+            weread_breaker.record(False)
+            response = None
+            continue
+        if _is_throttled(response):
+            print(f"⚠️ WeRead 限流或服务端错误 ({attempt + 1}/{WEREAD_MAX_RETRIES + 1}): {url} - {response.status_code}")
+            weread_breaker.record(False)
+            continue
+        weread_breaker.record(True)
+        if not revalidated:
+            if cache_key and response.status_code == 200 and not _is_error_body(response):
+                cache.store(cache_key, response)
+            else:
+                http_cache.mark_untracked()
+        if span:
+            span.end(status=response.status_code, bytes=len(response.content))
+        return response
+    incr_metric("weread_failures")
+    http_cache.mark_untracked()
+    if span:
+        span.end(status=response.status_code if response is not None else None, error="重试次数用尽")
+    return response
+
 # 解析cookie字符串
 def parse_cookie_string(cookie_string):
     cookie_dict = {}
@@ -61,8 +398,8 @@ def refrensh_weread_session(wx_cookie):
             headers = get_headers(wx_cookie)
             response = requests.get(url, headers=headers, timeout=10, allow_redirects=True)
             
-            # 正确处理set-cookie头
-            print(f"R Set-Cookie头: {response.headers}")
+            # 正确处理set-cookie头（响应头中含Cookie，不输出）
+            print(f"R 状态码: {response.status_code}")
 
             set_cookie_header = response.headers.get('set-cookie')
             if set_cookie_header:
@@ -78,11 +415,11 @@ def refrensh_weread_session(wx_cookie):
                         end = len(set_cookie_header)
                     new_wr_skey = set_cookie_header[start:end]
                     
-                    print(f"✅ 获取到新的wr_skey: {new_wr_skey}")
+                    print(f"✅ 获取到新的wr_skey（{len(new_wr_skey)}位）")
                     
                     # 更新Cookie中的wr_skey
                     updated_cookie = update_wr_skey_in_cookie(wx_cookie, new_wr_skey)
-                    print(f"✅ 更新后的Cookie: {updated_cookie}")
+                    print("✅ 已更新Cookie中的wr_skey")
 
 
 
@@ -122,46 +459,95 @@ def get_api_headers(cookie_str, bookId):
         
     }
 # 通用的Notion API请求函数
-def notion_api_request(method, endpoint, payload=None, notion_token=None, timeout=30):
-    """通用的Notion API请求函数 - 强制显示错误详情"""
+def _notion_idempotent(method, endpoint):
+    """重复发送也不会产生副作用的请求 - 创建页面和追加子块除外"""
+    method = method.upper()
+    if method == "POST":
+        return endpoint.endswith("/query")
+    if method == "PATCH":
+        return not endpoint.endswith("/children")
+    return True
+
+def _notion_should_retry(method, endpoint, response):
+    """response 为None表示请求异常（超时、连接断开）"""
+    if response is not None and response.status_code in (429, 502, 503):
+        # 服务端没有处理这个请求，任何方法都可以重试
+        return True
+    if response is None or response.status_code in (500, 504):
+        # 写入可能已经生效，只重试幂等请求
+        return _notion_idempotent(method, endpoint)
+    return False
+
+def notion_api_request(method, endpoint, payload=None, notion_token=None, timeout=None, body=None):
+    """通用的Notion API请求函数 - 失败时输出截断后的载荷和错误响应（不输出请求头）
+
+    body 为已编码好的JSON字节时直接发送，不再序列化 payload。
+    所有请求按 NOTION_RATE_LIMIT 排队发送；429/5xx/网络异常按 _notion_should_retry 退避重试，
+    优先使用服务端的 Retry-After
+    """
     headers = {
         "Authorization": f"Bearer {notion_token}",
         "Notion-Version": "2022-06-28",
         "Content-Type": "application/json"
     }
     
-    url = f"https://api.notion.com/v1{endpoint}"
+    url = f"{NOTION_API_BASE}{endpoint}"
+    timeout = timeout or NOTION_TIMEOUT
+    send = {"data": body} if body is not None else {"json": payload}
+    method = method.upper()
+    if method not in ("POST", "GET", "PATCH", "DELETE"):
+        raise ValueError(f"不支持的HTTP方法: {method}")
     
-    try:
-        if method.upper() == "POST":
-            response = requests.post(url, headers=headers, json=payload, timeout=timeout)
-        elif method.upper() == "GET":
-            response = requests.get(url, headers=headers, timeout=timeout)
-        elif method.upper() == "PATCH":
-            response = requests.patch(url, headers=headers, json=payload, timeout=timeout)
-        else:
-            raise ValueError(f"不支持的HTTP方法: {method}")
-        
-        if response.status_code == 200:
-            return response.json()
-        else:
-            # 🔴 关键：显示完整的错误响应
-            print(f"🔴 Notion API调用失败: {response.status_code}")
-            print(f"🔴 URL: {url}")
-            print(f"🔴 请求头: {headers}")
-            print(f"🔴 请求载荷: {json.dumps(payload, indent=2, ensure_ascii=False)}")
-            print("🔴 完整错误响应:")
-            print(response.text)  # 这行最重要！
-            print("🔴" + "="*50)
+    with tracer.span("notion.http", method=method, endpoint=endpoint.split("?")[0], retries=0) as span:
+        for attempt in range(NOTION_MAX_RETRIES + 1):
+            if attempt > 0:
+                incr_metric("notion_retries")
+                if span:
+                    span.set(retries=attempt)
+            notion_pacer.wait()
+            incr_metric("notion_requests")
+            error = None
+            try:
+                if method in ("POST", "PATCH"):
+                    response = requests.request(method, url, headers=headers, timeout=timeout, **send)
+                else:
+                    response = requests.request(method, url, headers=headers, timeout=timeout)
+            except Exception as e:
+                response, error = None, e
+            if span and response is not None:
+                span.set(status=response.status_code, bytes=len(response.content))
+
+            if response is not None and response.status_code == 200:
+                return response.json()
+            if attempt < NOTION_MAX_RETRIES and _notion_should_retry(method, endpoint, response):
+                retry_after = response.headers.get("Retry-After") if response is not None else None
+                delay = min(_backoff_delay(attempt + 1, retry_after), NOTION_BACKOFF_MAX)
+                if response is not None and response.status_code == 429:
+                    # 限流针对整个集成，其他线程也一起暂停
+                    notion_pacer.pause(delay)
+                print(f"⚠️ Notion {response.status_code if response is not None else error}，"
+                      f"{delay:.1f}s 后重试 ({attempt + 1}/{NOTION_MAX_RETRIES}): {method} {endpoint.split('?')[0]}")
+                time.sleep(delay)
+                continue
+
+            if error is not None:
+                print(f"🔴 API请求异常: {method} {url} - {error}")
+                if span:
+                    span.set(error=truncate(str(error)))
+                return None
+            # 🔴 关键：显示错误响应，载荷过长时截断
+            if body is not None:
+                payload_text = body.decode("utf-8", "replace")
+            else:
+                payload_text = json.dumps(payload, ensure_ascii=False) if payload is not None else ""
+            print(f"🔴 Notion API调用失败: {response.status_code} {method} {url}")
+            print(f"🔴 请求载荷: {truncate(payload_text, NOTION_ERROR_PAYLOAD_CHARS)}")
+            print(f"🔴 错误响应: {truncate(response.text, NOTION_ERROR_PAYLOAD_CHARS)}")
+            if span:
+                span.set(error=truncate(response.text))
             return None
-            
-    except Exception as e:
-        print(f"🔴 API请求异常: {e}")
-        import traceback
-        print(f"🔴 详细异常: {traceback.format_exc()}")
-        return None
 
-def query_database(database_id, filter_condition=None, sorts=None, page_size=1, notion_token=None):
+def query_database(database_id, filter_condition=None, sorts=None, page_size=1, notion_token=None, start_cursor=None):
     # 查询数据库 - 
     endpoint = f"/databases/{database_id}/query"
     
@@ -174,26 +560,125 @@ def query_database(database_id, filter_condition=None, sorts=None, page_size=1,
         payload["filter"] = filter_condition  # 直接放在顶层
     if sorts:
         payload["sorts"] = sorts              # 直接放在顶层
+    if start_cursor:
+        payload["start_cursor"] = start_cursor
     
     return notion_api_request("POST", endpoint, payload, notion_token)
+
+def query_all_pages(database_id, notion_token, filter_condition=None, sorts=None):
+    """分页查询数据库，返回页面列表，任何一页失败返回None"""
+    pages = []
+    start_cursor = None
+    while True:
+        response = query_database(database_id, filter_condition=filter_condition, sorts=sorts, page_size=100,
+                                  notion_token=notion_token, start_cursor=start_cursor)
+        if response is None:
+            return None
+        pages.extend(response.get("results", []))
+        if not response.get("has_more"):
+            return pages
+        start_cursor = response.get("next_cursor")
 # 在数据库中创建新页面
 def create_page_in_database(database_id, properties, notion_token=None):
-    """在数据库中创建新页面"""
+    """在数据库中创建新页面 - 发送前按数据库结构校验属性"""
     endpoint = "/pages"
     
     payload = {
         "parent": {"database_id": database_id},
-        "properties": properties
+        "properties": adapt_properties(properties, get_database_schema(database_id, notion_token))
     }
     
     return notion_api_request("POST", endpoint, payload, notion_token)
 
 # 更新页面属性
-def update_page(page_id, properties, notion_token=None):
-    """更新页面属性"""
+def update_page(page_id, properties, notion_token=None, database_id=None):
+    """更新页面属性 - 传入database_id时按数据库结构校验属性"""
     endpoint = f"/pages/{page_id}"
+    if database_id:
+        properties = adapt_properties(properties, get_database_schema(database_id, notion_token))
     payload = {"properties": properties}
     return notion_api_request("PATCH", endpoint, payload, notion_token)
+
+def _normalize_date(text, time_zone=None):
+    """日期统一成一种形式再比较: 只有日期的保持 YYYY-MM-DD，带时间的换算成UTC的ISO字符串
+
+    写入时是 "2023-11-20 17:06:40" + time_zone，Notion 返回 "2023-11-20T17:06:40.000+08:00"
+    """
+    if not text or len(text) <= 10:
+        return text
+    try:
+        value = datetime.fromisoformat(text.replace("Z", "+00:00"))
+    except ValueError:
+        return text
+    if value.tzinfo is None:
+        try:
+            value = value.replace(tzinfo=ZoneInfo(time_zone or "UTC"))
+        except (ValueError, KeyError, ZoneInfoNotFoundError):
+            return text
+    return value.astimezone(timezone.utc).isoformat(timespec="seconds")
+
+def _same_property(value, stored):
+    """待写入的属性值（已按数据库结构转换）与数据库中已存储的值是否相同"""
+    if not stored:
+        return False
+    prop_type = next(iter(value))
+    if stored.get("type") != prop_type:
+        return False
+    if prop_type == "date":
+        new, old = value["date"] or {}, stored.get("date") or {}
+        return all(_normalize_date(new.get(key), new.get("time_zone")) == _normalize_date(old.get(key), old.get("time_zone"))
+                   for key in ("start", "end"))
+    return _property_plain_value(value) == _property_plain_value({prop_type: stored.get(prop_type)})
+
+class PageWriteBuffer:
+    """页面属性写入缓冲 - 一次运行中对同一页面的多次属性更新合并成一次PATCH
+
+    各处只调用 set()，页面写完后 flush()；先按数据库结构转换类型（如 select → status），
+    再与数据库索引中已存储的值比较，相同的属性不发送
+    """
+
+    def __init__(self, database_id, notion_token, stored=None):
+        self.database_id = database_id
+        self.notion_token = notion_token
+        # {page_id: 数据库查询结果中的 properties}
+        self.stored = stored or {}
+        self.pending = {}
+        self.writes = {}
+        self.lock = threading.Lock()
+
+    def set(self, page_id, properties):
+        with self.lock:
+            self.pending.setdefault(page_id, {}).update(properties)
+            self.writes[page_id] = self.writes.get(page_id, 0) + 1
+        incr_metric("notion_prop_writes_buffered")
+
+    def flush(self, page_id):
+        """发送页面的合并更新，没有需要发送的内容时直接返回True"""
+        with self.lock:
+            properties = self.pending.pop(page_id, {})
+            writes = self.writes.pop(page_id, 0)
+            stored = self.stored.get(page_id, {})
+        if properties:
+            properties = adapt_properties(properties, get_database_schema(self.database_id, self.notion_token))
+        changed = {name: value for name, value in properties.items()
+                   if not _same_property(value, stored.get(name))}
+        incr_metric("notion_props_unchanged_skipped", len(properties) - len(changed))
+        if not changed:
+            incr_metric("notion_patches_saved", writes)
+            return True
+        # 已经转换过，不再重复校验
+        response = update_page(page_id, changed, self.notion_token)
+        incr_metric("notion_patches_saved", writes - 1)
+        if not response:
+            return False
+        with self.lock:
+            self.stored[page_id] = response.get("properties", {})
+        return True
+
+    def flush_all(self):
+        with self.lock:
+            page_ids = list(self.pending)
+        return all([self.flush(page_id) for page_id in page_ids])
 # 查找page
 def get_pages(page_id, notion_token):
     """更新页面属性"""
@@ -206,6 +691,111 @@ def get_database_info(database_id, notion_token=None):
     endpoint = f"/databases/{database_id}"
     return notion_api_request("GET", endpoint, notion_token=notion_token)
 
+# 数据库结构缓存 - 只在本次运行的进程内有效，每次运行拉取一次；本次运行新建的属性由 cache_database_schema 直接更新
+_schema_cache = {}
+_schema_lock = threading.Lock()
+NOTION_TEXT_LIMIT = 2000
+
+def get_database_schema(database_id, notion_token):
+    """获取数据库属性结构 {属性名: {"type": 类型, "options": 可选值}}，获取失败返回None"""
+    with _schema_lock:
+        cached = _schema_cache.get(database_id)
+        if cached:
+            return cached
+        info = get_database_info(database_id, notion_token)
+        if not info:
+            print("⚠️ 获取数据库结构失败，跳过属性校验")
+            return None
+        return cache_database_schema(database_id, info)
+
+def cache_database_schema(database_id, info):
+    """用数据库对象（GET/PATCH /databases 的响应）更新结构缓存"""
+    properties = {}
+    for name, prop in info.get("properties", {}).items():
+        prop_type = prop.get("type")
+        options = None
+        if prop_type in ("select", "status", "multi_select"):
+            options = {o.get("name") for o in prop.get(prop_type, {}).get("options", [])}
+        properties[name] = {"type": prop_type, "options": options}
+    schema = {"properties": properties}
+    _schema_cache[database_id] = schema
+    print(f"✅ 已缓存数据库结构: {len(properties)} 个属性")
+    return schema
+
+def _property_plain_value(value):
+    """取出属性值里的纯文本/数值，用于类型转换"""
+    prop_type, data = next(iter(value.items()))
+    if prop_type in ("title", "rich_text"):
+        return "".join(t.get("text", {}).get("content", "") for t in data)
+    if prop_type in ("select", "status"):
+        return data.get("name") if data else None
+    if prop_type == "multi_select":
+        return data[0].get("name") if data else None
+    if prop_type == "files":
+        return data[0].get("external", {}).get("url") if data else None
+    if prop_type == "date":
+        return data.get("start") if data else None
+    return data
+
+def _build_property(prop_type, plain):
+    """按目标类型重建属性值，无法转换时返回None"""
+    if prop_type in ("title", "rich_text"):
+        return {prop_type: [{"type": "text", "text": {"content": str(plain)[:NOTION_TEXT_LIMIT]}}]}
+    if prop_type in ("select", "status"):
+        return {prop_type: {"name": str(plain)}}
+    if prop_type == "multi_select":
+        return {prop_type: [{"name": str(plain)}]}
+    if prop_type == "url":
+        return {"url": str(plain)}
+    if prop_type == "files":
+        return {"files": [{"type": "external", "name": "Cover", "external": {"url": str(plain)}}]}
+    if prop_type == "number":
+        try:
+            return {"number": float(plain) if "." in str(plain) else int(plain)}
+        except (TypeError, ValueError):
+            return None
+    if prop_type == "date":
+        return {"date": {"start": str(plain)}}
+    return None
+
+def adapt_properties(properties, schema):
+    """发送前本地校验属性 - 丢弃不存在的属性，转换类型不符的属性，截断超长文本
+
+    可预见的400错误在这里处理掉，不浪费一次请求
+    """
+    if not schema:
+        return properties
+    adapted = {}
+    for name, value in properties.items():
+        expected = schema["properties"].get(name)
+        if not expected:
+            print(f"⚠️ 数据库中没有属性 {name}，已跳过")
+            incr_metric("notion_props_dropped")
+            continue
+        prop_type = expected["type"]
+        actual_type = next(iter(value))
+        if actual_type == prop_type and prop_type in ("title", "rich_text"):
+            value = {prop_type: [
+                {**t, "text": {**t["text"], "content": t["text"]["content"][:NOTION_TEXT_LIMIT]}} if "text" in t else t
+                for t in value[prop_type]
+            ]}
+        elif actual_type != prop_type:
+            plain = _property_plain_value(value)
+            value = _build_property(prop_type, plain) if plain not in (None, "") else None
+            if value is None:
+                print(f"⚠️ 属性 {name} 无法从 {actual_type} 转换为 {prop_type}，已跳过")
+                incr_metric("notion_props_dropped")
+                continue
+            incr_metric("notion_props_adapted")
+        # status 不能通过API新建选项
+        if prop_type == "status" and expected["options"] is not None:
+            if value["status"].get("name") not in expected["options"]:
+                print(f"⚠️ 状态 {value['status'].get('name')} 不在属性 {name} 的选项中，已跳过")
+                incr_metric("notion_props_dropped")
+                continue
+        adapted[name] = value
+    return adapted
+
 # 获取Notion页面中所有笔记块的唯一标识
 def get_existing_note_ids(notion_token,page_id):
     """获取Notion页面中所有笔记块的唯一标识"""
@@ -287,9 +877,11 @@ def check(bookId, database_id, notion_token):
         }
         
         print(f"检查书籍是否存在: {bookId}")
+        # 按创建时间升序，存在重复时总是返回最早的那一页
         response = query_database(
             database_id=database_id,
             filter_condition=filter_condition,
+            sorts=[{"timestamp": "created_time", "direction": "ascending"}],
             notion_token=notion_token
         )
         
@@ -367,6 +959,285 @@ def check(bookId, database_id, notion_token):
         print(f"详细错误: {traceback.format_exc()}")
         return False
 
+# 创建日志 - 创建前先登记预约，成功后记录页面ID，保证重试和重复运行不会产生重复页面
+_journal_lock = threading.Lock()
+
+def load_create_journal():
+    """读取本地创建日志"""
+    try:
+        with open(CREATE_JOURNAL_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_json_atomic(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def update_create_journal(book_id, state, page_id=None):
+    """更新某本书的创建状态: pending / created"""
+    with _journal_lock:
+        journal = load_create_journal()
+        journal[book_id] = {"state": state, "page_id": page_id, "ts": int(time.time())}
+        _write_json_atomic(CREATE_JOURNAL_FILE, journal)
+
+def forget_journal_pages(page_ids):
+    """从创建日志中删除指向这些页面的记录（页面被归档或删除后调用）"""
+    page_ids = set(page_ids)
+    with _journal_lock:
+        journal = load_create_journal()
+        stale = [book_id for book_id, entry in journal.items() if entry.get("page_id") in page_ids]
+        if not stale:
+            return 0
+        for book_id in stale:
+            del journal[book_id]
+        _write_json_atomic(CREATE_JOURNAL_FILE, journal)
+    return len(stale)
+
+def _rich_text_plain(prop):
+    return "".join(t.get("plain_text", "") for t in (prop or {}).get("rich_text", []))
+
+def _index_from_pages(pages):
+    """页面列表 → {BookId: {"page_id", "digest", "properties"}}，同一BookId保留最早创建的那一页"""
+    index = {}
+    for page in sorted(pages, key=lambda p: p.get("created_time") or ""):
+        properties = page.get("properties", {})
+        book_id = _rich_text_plain(properties.get("BookId"))
+        if book_id and book_id not in index and book_id != LEASE_BOOK_ID:
+            index[book_id] = {
+                "page_id": page["id"],
+                "digest": _rich_text_plain(properties.get(DIGEST_PROPERTY)),
+                "properties": properties,
+            }
+    return index
+
+def load_persisted_index(database_id):
+    """读取持久化的索引，不是同一个数据库时返回None"""
+    try:
+        with open(NOTION_INDEX_FILE, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return state if state.get("database_id") == database_id else None
+
+def invalidate_persisted_index():
+    """删除持久化的索引，下次运行全量扫描"""
+    try:
+        os.remove(NOTION_INDEX_FILE)
+    except OSError:
+        pass
+
+def load_notion_index(database_id, notion_token, book_ids=None, persist=True):
+    """读取数据库索引 - 返回 {BookId: {"page_id", "digest", "properties"}}，读取失败返回None
+
+    索引和 last_edited_time 高水位一起持久化：启动时只查询高水位之后编辑过的页面（按编辑时间升序），
+    请求数与最近的编辑量成正比；超过 NOTION_INDEX_FULL_SCAN_SECONDS 后全量扫描一次，发现被删除的页面。
+    同一BookId有多页时保留最早创建的那一页，与 check() 一致；
+    传入book_ids时只返回这些书，没有可用的持久化索引时只查询这些书（每次查询最多100个条件）；
+    persist=False（预演）时不写回持久化的索引
+    """
+    state = load_persisted_index(database_id)
+    full_scan = not state or time.time() - state.get("full_scan_at", 0) >= NOTION_INDEX_FULL_SCAN_SECONDS
+
+    if full_scan and book_ids is not None:
+        # 定向同步不做全量扫描，也不更新持久化的索引
+        pages = []
+        book_ids = list(book_ids)
+        for i in range(0, len(book_ids), 100):
+            filter_condition = {"or": [{"property": "BookId", "rich_text": {"equals": book_id}}
+                                       for book_id in book_ids[i:i + 100]]}
+            result = query_all_pages(database_id, notion_token, filter_condition,
+                                     [{"timestamp": "created_time", "direction": "ascending"}])
+            if result is None:
+                print("❌ 读取数据库索引失败")
+                return None
+            pages.extend(result)
+        index = _index_from_pages(pages)
+        print(f"✅ 已读取数据库索引: {len(index)} 本书")
+        return index
+
+    if full_scan:
+        stored_pages = {}
+        high_water = None
+        result = query_all_pages(database_id, notion_token, None,
+                                 [{"timestamp": "created_time", "direction": "ascending"}])
+    else:
+        stored_pages = state["pages"]
+        high_water = state.get("high_water")
+        filter_condition = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": high_water}}
+        result = query_all_pages(database_id, notion_token, filter_condition if high_water else None,
+                                 [{"timestamp": "last_edited_time", "direction": "ascending"}])
+    if result is None:
+        print("❌ 读取数据库索引失败")
+        return None
+
+    for page in result:
+        if page.get("archived"):
+            stored_pages.pop(page["id"], None)
+            continue
+        stored_pages[page["id"]] = {
+            "id": page["id"],
+            "created_time": page.get("created_time"),
+            "last_edited_time": page.get("last_edited_time"),
+            "properties": page.get("properties", {}),
+        }
+        edited = page.get("last_edited_time")
+        if edited and (high_water is None or edited > high_water):
+            high_water = edited
+    if persist:
+        _write_json_atomic(NOTION_INDEX_FILE, {
+            "database_id": database_id,
+            "high_water": high_water,
+            "full_scan_at": time.time() if full_scan else state.get("full_scan_at", 0),
+            "pages": stored_pages,
+        })
+
+    index = _index_from_pages(stored_pages.values())
+    if full_scan:
+        incr_metric("notion_index_full_scans")
+        print(f"✅ 已全量读取数据库索引: {len(index)} 本书")
+    else:
+        incr_metric("notion_index_delta_pages", len(result))
+        print(f"✅ 已增量刷新数据库索引: {len(result)} 个页面有编辑，共 {len(index)} 本书")
+    if book_ids is not None:
+        wanted = set(book_ids)
+        index = {book_id: entry for book_id, entry in index.items() if book_id in wanted}
+    return index
+
+def ensure_digest_property(database_id, notion_token):
+    """确保数据库中存在摘要属性，不存在时自动创建（可在视图中隐藏）"""
+    schema = get_database_schema(database_id, notion_token)
+    if not schema or DIGEST_PROPERTY in schema["properties"]:
+        return
+    payload = {"properties": {DIGEST_PROPERTY: {"rich_text": {}}}}
+    response = notion_api_request("PATCH", f"/databases/{database_id}", payload, notion_token)
+    if response:
+        print(f"✅ 已创建摘要属性: {DIGEST_PROPERTY}")
+        with _schema_lock:
+            cache_database_schema(database_id, response)
+
+def notebook_marker(book):
+    """笔记本条目的变化标记: 划线数:想法数:书签数:更新时间"""
+    return f"{book.get('noteCount', 0)}:{book.get('reviewCount', 0)}:{book.get('bookmarkCount', 0)}:{book.get('sort', 0)}"
+
+def split_digest(digest):
+    """摘要拆成 (变化标记, 内容哈希)"""
+    if not digest or ":" not in digest:
+        return None, None
+    marker, content_hash = digest.rsplit(":", 1)
+    return marker, content_hash
+
+def save_book_digest(page_id, marker, content_hash, database_id, notion_token, write_buffer=None):
+    """写入书籍摘要属性 - 传入write_buffer时只放入缓冲，随页面的其他属性一起发送"""
+    digest = f"{marker}:{content_hash}"
+    properties = {DIGEST_PROPERTY: {"rich_text": [{"type": "text", "text": {"content": digest}}]}}
+    if write_buffer is not None:
+        write_buffer.set(page_id, properties)
+        return True
+    return update_page(page_id, properties, notion_token, database_id)
+
+def lookup_book_page(book_id, database_id, notion_token):
+    """按BookId查询最早创建的页面 - 返回 (查询是否成功, 页面ID)"""
+    response = query_database(
+        database_id=database_id,
+        filter_condition={"property": "BookId", "rich_text": {"equals": book_id}},
+        sorts=[{"timestamp": "created_time", "direction": "ascending"}],
+        notion_token=notion_token
+    )
+    if response is None:
+        return False, None
+    results = response.get("results", [])
+    return True, (results[0]["id"] if results else None)
+
+def _same_notion_id(a, b):
+    """Notion ID 比较 - 带不带连字符都是同一个ID"""
+    return bool(a and b) and a.replace("-", "").lower() == b.replace("-", "").lower()
+
+def create_page_idempotent(database_id, book_id, properties, notion_token):
+    """幂等创建书籍页面 - 返回页面ID
+
+    1. 日志中已记录创建成功、且页面仍然有效（未归档、在当前数据库中、BookId一致）的直接复用；
+       页面已被删除、归档或属于其他数据库（换了 database_id）时按 pending 处理，重新确认
+    2. 创建前登记 pending 预约
+    3. 创建失败（包括响应丢失）后按 BookId 查询确认，页面已存在则不再重复创建
+    """
+    entry = load_create_journal().get(book_id)
+    if entry and entry.get("state") == "created" and entry.get("page_id"):
+        page = notion_api_request("GET", f"/pages/{entry['page_id']}", notion_token=notion_token)
+        if (page and not page.get("archived")
+                and _same_notion_id(page.get("parent", {}).get("database_id"), database_id)
+                and _rich_text_plain(page.get("properties", {}).get("BookId")) == book_id):
+            print(f"ℹ️ 创建日志中已存在页面: {book_id}")
+            return entry["page_id"]
+        print(f"⚠️ 创建日志中的页面已失效，重新确认: {book_id}")
+        entry = {"state": "pending"}
+    if entry and entry.get("state") == "pending":
+        # 上次创建结果未知，先确认
+        ok, page_id = lookup_book_page(book_id, database_id, notion_token)
+        if page_id:
+            update_create_journal(book_id, "created", page_id)
+            return page_id
+        if not ok:
+            return None
+
+    update_create_journal(book_id, "pending")
+    for attempt in range(NOTION_CREATE_RETRIES + 1):
+        if attempt > 0:
+            time.sleep(_backoff_delay(attempt))
+            incr_metric("notion_create_retries")
+        response = create_page_in_database(database_id, properties, notion_token)
+        if response and response.get("id"):
+            update_create_journal(book_id, "created", response["id"])
+            return response["id"]
+        # 请求失败不代表没有创建成功，重试前先确认
+        ok, page_id = lookup_book_page(book_id, database_id, notion_token)
+        if page_id:
+            print(f"ℹ️ 创建请求失败但页面已存在，复用: {page_id}")
+            update_create_journal(book_id, "created", page_id)
+            return page_id
+        if not ok:
+            print(f"⚠️ 无法确认页面是否已创建，保留预约待下次运行确认: {book_id}")
+            return None
+    return None
+
+def archive_page(page_id, notion_token):
+    """归档页面"""
+    return notion_api_request("PATCH", f"/pages/{page_id}", {"archived": True}, notion_token)
+
+def dedupe_book_pages(database_id, notion_token, max_workers=4):
+    """批量去重 - 同一 BookId 只保留最早创建的页面，其余并行归档
+
+    返回 {"success": 归档数, "error": 归档失败数, "total": 重复页面数}，查询失败时返回None
+    """
+    pages = query_all_pages(database_id, notion_token, sorts=[{"timestamp": "created_time", "direction": "ascending"}])
+    if pages is None:
+        print("❌ 查询数据库失败，未执行去重")
+        return None
+    pages_by_book = {}
+    for page in pages:
+        rich_text = page.get("properties", {}).get("BookId", {}).get("rich_text", [])
+        book_id = "".join(t.get("plain_text", "") for t in rich_text)
+        if book_id:
+            pages_by_book.setdefault(book_id, []).append(page["id"])
+
+    duplicates = [page_id for page_ids in pages_by_book.values() for page_id in page_ids[1:]]
+    print(f"🔍 共 {len(pages_by_book)} 本书，发现 {len(duplicates)} 个重复页面")
+    if not duplicates:
+        return {"success": 0, "error": 0, "total": 0}
+    # 归档的页面不会出现在增量查询中，下次运行重新全量扫描
+    invalidate_persisted_index()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda page_id: archive_page(page_id, notion_token), duplicates))
+    archived = sum(1 for r in results if r)
+    print(f"✅ 已归档 {archived}/{len(duplicates)} 个重复页面")
+    # 创建日志不能再指向已归档的页面
+    forget_journal_pages(page_id for page_id, r in zip(duplicates, results) if r)
+    return {"success": archived, "error": len(duplicates) - archived, "total": len(duplicates)}
+
 def add_book_to_notion(book, sort, database_id, notion_token):
     """添加书籍到Notion - 根据实际数据库结构"""
     try:
@@ -418,8 +1289,8 @@ def add_book_to_notion(book, sort, database_id, notion_token):
     except Exception as e:
         print(f"❌ 添加书籍到Notion时出错: {e}")
         return False
-def update_book_in_notion(page_id, book, sort, notion_token):
-    """更新Notion中的书籍信息"""
+def update_book_in_notion(page_id, book, sort, notion_token, database_id=None, write_buffer=None):
+    """更新Notion中的书籍信息 - 传入write_buffer时只放入缓冲"""
     try:
         # 安全地获取标题
         title = "未知标题"
@@ -429,8 +1300,11 @@ def update_book_in_notion(page_id, book, sort, notion_token):
         properties = {
             "Sort": {"number": sort}
         }
+        if write_buffer is not None:
+            write_buffer.set(page_id, properties)
+            return True
         
-        response = update_page(page_id, properties, notion_token)
+        response = update_page(page_id, properties, notion_token, database_id)
             
     except Exception as e:
         print(f"更新书籍时出错: {e}")
@@ -441,11 +1315,15 @@ def get_bookshelf(session,wx_cookie):
     try:
         url = WEREAD_NOTEBOOKS_URL
         headers = get_headers(wx_cookie)       
-        response = session.get(WEREAD_NOTEBOOKS_URL, headers=headers)
+        response = weread_request(session, "GET", WEREAD_NOTEBOOKS_URL, headers=headers)
+        if response is None:
+            print("获取书架失败: 请求异常")
+            return None
         if response.status_code == 200:
-            r = response.json()["books"]
-            print(f"book===: {r}")
-            return response.json()
+            # 响应只解析一次
+            data = response.json()
+            print(f"book===: {len(data.get('books') or [])} 本")
+            return data
         else:
             print(f"获取书架失败: {response.status_code} - {response.text}")
             return None
@@ -459,10 +1337,15 @@ def get_chapter_info(session,bookId,wx_cookie):
         'synckeys': [0],
         'teenmode': 0
     }
-    r = session.post(WEREAD_CHAPTER_INFO, json=body)
-    if r.ok and "data" in r.json() and len(r.json()["data"]) == 1 and "updated" in r.json()["data"][0]:
-        update = r.json()["data"][0]["updated"]
-        return {item["chapterUid"]: item for item in update}
+    r = weread_request(session, "POST", WEREAD_CHAPTER_INFO, json=body)
+    if r is None or not r.ok:
+        return None
+    try:
+        data = r.json().get("data") or []
+    except ValueError:
+        return None
+    if len(data) == 1 and "updated" in data[0]:
+        return {item["chapterUid"]: item for item in data[0]["updated"]}
     return None
 
 def get_bookmark_list(session,bookId,wx_cookie):
@@ -478,11 +1361,13 @@ def get_bookmark_list(session,bookId,wx_cookie):
         print(f"bookid : {bookId}")    
 
         headers = get_api_headers(wx_cookie,bookId)       
-        response = session.get(url, params=params,  timeout=30,headers=headers)
+        response = weread_request(session, "GET", url, params=params, headers=headers)
+        if response is None:
+            print("获取划线失败: 请求异常")
+            return None
 
         if response.status_code == 200:
             data = response.json()
-            
 
             # print(f"✅ 获取划线列表成功: {data} ")
             if data.get('errCode') == -2012:
@@ -492,12 +1377,8 @@ def get_bookmark_list(session,bookId,wx_cookie):
 
                 return get_bookmark_list(session,bookId,new_cookie)
 
-            updated = data.get("updated")
-            updated = sorted(
-                updated,
-                key=lambda x: (x.get("chapterUid", 1), int(x.get("range").split("-")[0])),
-            )
-            return data["updated"]
+            # 排序统一在 merge_highlights 中按章节顺序完成
+            return data.get("updated") or []
 
         
         else:
@@ -508,59 +1389,78 @@ def get_bookmark_list(session,bookId,wx_cookie):
         print(f"获取划线异常: {e}")
         return None
 
-def get_review_list(session,bookId,wx_cookie):
-    """获取笔记列表 - 使用正确的API端点"""
+def iter_reviews(session, bookId, wx_cookie, page_size=None):
+    """分页流式获取笔记 - 逐条产出 ("summary", 点评) 或 ("review", 想法)
 
+    点评(type 4)保留原始结构，想法(type 1)取出 review 并把 content 改名为 markText；
+    内存占用只和单页大小有关，和笔记总数无关。
+    任何一页获取失败都抛出 RuntimeError，不能把不完整的列表当作全部笔记写入
+    """
     url = WEREAD_REVIEW_LIST_URL
-    params = {
-        'bookId': bookId,
-        'synckey': 0,
-        'mine': 1,
-        'listType': 11,
-
-    }
-    # 使用参考项目的完整请求头
-    # headers = get_api_headers(cookie_str,bookId)           
-    headers = get_api_headers(wx_cookie,bookId)       
-
-    response = session.get(url, params=params)
-    if response.status_code == 200:
+    page_size = page_size or WEREAD_REVIEW_PAGE_SIZE
+    max_idx = 0
+    refreshed = False
+    while True:
+        params = {
+            'bookId': bookId,
+            'synckey': 0,
+            'mine': 1,
+            'listType': 11,
+            'count': page_size,
+            'maxIdx': max_idx,
+        }
+        response = weread_request(session, "GET", url, params=params)
+        if response is None:
+            raise RuntimeError(f"获取笔记列表失败: 请求异常 (maxIdx={max_idx})")
+        if response.status_code != 200:
+            raise RuntimeError(f"获取笔记列表失败: {response.status_code} (maxIdx={max_idx})")
         data = response.json()
-        reviews = data.get('reviews', [])
-        # print(f"✅ 获取笔记列表成功: {data} ")
         if data.get('errCode') == -2012:
+            if refreshed:
+                raise RuntimeError("获取笔记列表失败: 刷新Cookie后仍然登录超时")
             print("❌ 登录超时 (401 + errcode: -2012),需要重新获取Cookie")
-             # 直接刷新Cookie
-        
-            new_token = refrensh_weread_session(wx_cookie)
-            # 递归重试
-            return get_review_list(session,bookId,new_token)
-        
-        # 分离总结和笔记
-        summary = list(filter(lambda x: x.get("review").get("type") == 4, reviews))
-        reviews = list(filter(lambda x: x.get("review").get("type") == 1, reviews))
-        reviews = list(map(lambda x: x.get("review"), reviews))
-        reviews = list(map(lambda x: {**x, "markText": x.pop("content")}, reviews))
-
-        return summary, reviews
-
+            # 刷新Cookie后重试当前页
+            wx_cookie = refrensh_weread_session(wx_cookie)
+            session.cookies.update(parse_cookie_string(wx_cookie))
+            refreshed = True
+            continue
+
+        page = data.get('reviews') or []
+        for item in page:
+            review = item.get("review") or {}
+            review_type = review.get("type")
+            if review_type == 4:
+                yield "summary", item
+            elif review_type == 1:
+                review = dict(review)
+                review["markText"] = review.pop("content", "")
+                yield "review", review
+        if not page or not data.get('hasMore'):
+            return
+        max_idx += len(page)
 
-    else:
-        print(f"❌ 获取笔记列表失败: {response.status_code} - {response.text}")
-        return [], []
+def get_review_list(session,bookId,wx_cookie):
+    """获取笔记列表 - 返回 (点评列表, 想法列表)"""
+    summary, reviews = [], []
+    for kind, item in iter_reviews(session, bookId, wx_cookie):
+        if kind == "summary":
+            summary.append(item)
+        else:
+            reviews.append(item)
+    return summary, reviews
 
 def get_read_info(session,bookId):
 
     params = dict(bookId=bookId, readingDetail=1,
                   readingBookIndex=1, finishedDate=1)
-    r = session.get(WEREAD_READ_INFO_URL, params=params)
-    if r.ok:
+    r = weread_request(session, "GET", WEREAD_READ_INFO_URL, params=params)
+    if r is not None and r.ok:
         return r.json()
     return None
 
 def get_bookinfo(session,bookId):
     """获取书籍信息 - 使用正确的API端点"""
-    url = f"https://i.weread.qq.com/book/info"
+    url = WEREAD_I_BOOK_INFO
     params = {
         'bookId': bookId
     }        
@@ -574,7 +1474,10 @@ def get_bookinfo(session,bookId):
     }
 
     
-    response = session.get(url, params=params, headers=headers)
+    response = weread_request(session, "GET", url, params=params, headers=headers)
+    if response is None:
+        print("❌ 获取书籍信息失败: 请求异常")
+        return '', 0
     if response.status_code == 200:
         data = response.json()
         print(f"🔍 调试 - 响应数据: {data}")
@@ -587,7 +1490,34 @@ def get_bookinfo(session,bookId):
         print(f"❌ 获取书籍信息失败: {response.status_code} - {response.text}")
         return '', 0
 
-def insert_to_notion(session,bookName, bookId, cover, sort, author,database_id, notion_token):
+def get_read_properties(read_info):
+    """阅读进度转换成页面属性: 状态、阅读时长、开始/读完日期"""
+    properties = {}
+    if read_info is None:
+        return properties
+    markedStatus = read_info.get("markedStatus", 0)
+    readingTime = read_info.get("readingTime", 0)
+    format_time = ""
+    hour = readingTime // 3600
+    if hour > 0:
+        format_time += f"{hour}时"
+    minutes = readingTime % 3600 // 60
+    if minutes > 0:
+        format_time += f"{minutes}分"
+    properties["Status"] = {"select": {
+        "name": "读完" if markedStatus == 4 else "在读"}}
+    properties["ReadingTime"] = {"rich_text": [
+        {"type": "text", "text": {"content": format_time}}]}
+    if "continueBeginDate" in read_info:
+        properties["BeginDate"] = {"date": {"start": datetime.utcfromtimestamp(read_info.get(
+            "continueBeginDate")).strftime("%Y-%m-%d")}}
+    if "finishedDate" in read_info:
+        properties["EndDate"] = {"date": {"start": datetime.utcfromtimestamp(read_info.get(
+            "finishedDate")).strftime("%Y-%m-%d %H:%M:%S"), "time_zone": "Asia/Shanghai"}}
+    return properties
+
+def insert_to_notion(session,bookName, bookId, cover, sort, author,database_id, notion_token,
+                     read_properties=None):
     """插入到notion-提"""
     time.sleep(0.3)
     parent = {
@@ -604,28 +1534,9 @@ def insert_to_notion(session,bookName, bookId, cover, sort, author,database_id,
         # "Rating": {"number": rating},
         "Cover": {"files": [{"type": "external", "name": "Cover", "external": {"url": cover}}]},
     }
-    read_info = get_read_info(session,bookId)
-    if read_info != None:
-        markedStatus = read_info.get("markedStatus", 0)
-        readingTime = read_info.get("readingTime", 0)
-        format_time = ""
-        hour = readingTime // 3600
-        if hour > 0:
-            format_time += f"{hour}时"
-        minutes = readingTime % 3600 // 60
-        if minutes > 0:
-            format_time += f"{minutes}分"
-        properties["Status"] = {"select": {
-            "name": "读完" if markedStatus == 4 else "在读"}}
-        properties["ReadingTime"] = {"rich_text": [
-            {"type": "text", "text": {"content": format_time}}]}
-        if "continueBeginDate" in read_info:
-            properties["BeginDate"] = {"date": {"start": datetime.utcfromtimestamp(read_info.get(
-                "continueBeginDate")).strftime("%Y-%m-%d")}}
-        if "finishedDate" in read_info:
-            properties["EndDate"] = {"date": {"start": datetime.utcfromtimestamp(read_info.get(
-                "finishedDate")).strftime("%Y-%m-%d %H:%M:%S"), "time_zone": "Asia/Shanghai"}}
-         
+    if read_properties is None:
+        read_properties = get_read_properties(get_read_info(session,bookId))
+    properties.update(read_properties)
 
     icon = {
         "type": "external",
@@ -633,10 +1544,8 @@ def insert_to_notion(session,bookName, bookId, cover, sort, author,database_id,
             "url": cover
         }
     }
-    response = create_page_in_database(database_id, properties, notion_token)
-    if response:
-        return response.get("id")  # 返回页面ID用于后续添加内容
-    return None
+    # 返回页面ID用于后续添加内容
+    return create_page_idempotent(database_id, bookId, properties, notion_token)
 
 def get_table_of_contents():
     """获取目录"""
@@ -721,27 +1630,60 @@ def get_callout(content, style, colorStyle, reviewId):
         }
     }
 
-def add_children(page_id, children, notion_token):
-    """添加子内容到Notion页面 - 处理分块添加"""
+def encode_block(block):
+    """块编码成紧凑的JSON字节 - 安装了 orjson 时使用它，两种后端输出相同的字节"""
+    if orjson is not None:
+        return orjson.dumps(block)
+    return json.dumps(block, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def encode_blocks(blocks):
+    return [encode_block(block) for block in blocks]
+
+def chunk_encoded(encoded, limit=NOTION_CHILDREN_LIMIT, max_bytes=NOTION_PAYLOAD_BYTES):
+    """按块数和字节数分组 - 返回 [(起始下标, 结束下标)]"""
+    chunks = []
+    start, size = 0, 0
+    for i, data in enumerate(encoded):
+        if i > start and (i - start >= limit or size + len(data) + 1 > max_bytes):
+            chunks.append((start, i))
+            start, size = i, 0
+        size += len(data) + 1
+    if start < len(encoded):
+        chunks.append((start, len(encoded)))
+    return chunks
+
+def children_body(encoded, after=None):
+    """已编码的块直接拼接成追加子块的请求体"""
+    body = b'{"children":[' + b",".join(encoded) + b"]"
+    if after:
+        body += b',"after":' + encode_block(after)
+    return body + b"}"
+
+def add_children(page_id, children, notion_token, after=None, encoded=None):
+    """添加子内容到Notion页面 - 按块数和请求体大小分块添加，传入after时插入到该块之后
+
+    encoded 为 children 已编码好的字节时直接使用，不再重复序列化
+    """
     if not children:
         print("⚠️ 没有子内容需要添加")
         return None
         
     try:
-        # Notion API限制每次最多100个子块
-        chunk_size = 100
-        for i in range(0, len(children), chunk_size):
-            chunk = children[i:i + chunk_size]
-            
-            endpoint = f"/blocks/{page_id}/children"
-            payload = {"children": chunk}
-            
-            print(f"🔄 添加子内容块 {i//chunk_size + 1}/{(len(children)-1)//chunk_size + 1}...")
-            response = notion_api_request("PATCH", endpoint, payload, notion_token)
+        if encoded is None:
+            encoded = encode_blocks(children)
+        chunks = chunk_encoded(encoded)
+        endpoint = f"/blocks/{page_id}/children"
+        for n, (start, end) in enumerate(chunks, 1):
+            print(f"🔄 添加子内容块 {n}/{len(chunks)}...")
+            response = notion_api_request("PATCH", endpoint, notion_token=notion_token,
+                                          body=children_body(encoded[start:end], after))
             
             if not response:
                 print(f"❌ 添加子内容块失败")
                 return None
+            if after and response.get("results"):
+                # 下一块接在刚插入的最后一个块之后
+                after = response["results"][-1]["id"]
                 
         print(f"✅ 成功添加所有子内容")
         return True
@@ -750,6 +1692,442 @@ def add_children(page_id, children, notion_token):
         print(f"❌ 添加子内容时出错: {e}")
         return None
 
+def list_block_children(block_id, notion_token):
+    """分页获取块的所有子块"""
+    results = []
+    start_cursor = None
+    while True:
+        endpoint = f"/blocks/{block_id}/children?page_size=100"
+        if start_cursor:
+            endpoint += f"&start_cursor={start_cursor}"
+        response = notion_api_request("GET", endpoint, None, notion_token)
+        if not response:
+            return None
+        results.extend(response.get("results", []))
+        if not response.get("has_more"):
+            return results
+        start_cursor = response.get("next_cursor")
+
+def delete_block(block_id, notion_token):
+    """删除块"""
+    return notion_api_request("DELETE", f"/blocks/{block_id}", None, notion_token)
+
+def clear_page_blocks(page_id, notion_token, max_workers=4, existing=None):
+    """删除页面上除子页面以外的所有块 - existing 为已获取的子块列表时不再重新获取"""
+    if existing is None:
+        existing = list_block_children(page_id, notion_token)
+    if existing is None:
+        print(f"❌ 获取页面内容失败: {page_id}")
+        return None
+    # 子页面单独维护，不在这里删除
+    block_ids = [b["id"] for b in existing if b.get("type") != "child_page"]
+    if block_ids:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            deleted = list(executor.map(lambda block_id: delete_block(block_id, notion_token), block_ids))
+        if not all(deleted):
+            print(f"❌ 清空页面内容失败: {page_id}")
+            return None
+    return True
+
+def replace_page_children(page_id, children, notion_token, max_workers=4, existing=None, encoded=None):
+    """清空页面内容后重新写入 - existing 为已获取的子块列表时不再重新获取"""
+    if not clear_page_blocks(page_id, notion_token, max_workers, existing):
+        return None
+    return add_children(page_id, children, notion_token, encoded=encoded)
+
+def create_child_page(parent_page_id, title, notion_token):
+    """在页面下创建子页面，返回子页面ID"""
+    payload = {
+        "parent": {"page_id": parent_page_id},
+        "properties": {"title": {"title": [{"type": "text", "text": {"content": title}}]}},
+    }
+    response = notion_api_request("POST", "/pages", payload, notion_token)
+    return response.get("id") if response else None
+
+def split_children_by_chapter(children):
+    """把 get_children 生成的块按标题拆成章节组 [(章节名, 块列表)]，开头的目录块不计入"""
+    groups = []
+    for block in children:
+        if block["type"] in ("heading_1", "heading_2", "heading_3"):
+            title = block[block["type"]]["rich_text"][0]["text"]["content"]
+            groups.append((title, []))
+        elif groups:
+            groups[-1][1].append(block)
+    return groups
+
+def _encoded_hash(encoded):
+    """已编码块列表的哈希 - 与整个列表编码后的哈希相同"""
+    return hashlib.sha1(b"[" + b",".join(encoded) + b"]").hexdigest()
+
+def _blocks_hash(blocks, encoded=None):
+    return _encoded_hash(encoded if encoded is not None else encode_blocks(blocks))
+
+def _block_hashes(encoded):
+    """每个块各自的哈希"""
+    return [hashlib.sha1(data).hexdigest() for data in encoded]
+
+_chapter_pages_lock = threading.Lock()
+
+def load_chapter_pages():
+    try:
+        with open(CHAPTER_PAGES_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _chapter_keys(groups):
+    """章节组加上状态键 [(键, 章节名, 块列表)]，同名章节加序号区分"""
+    seen = {}
+    keyed = []
+    for title, blocks in groups:
+        seen[title] = seen.get(title, 0) + 1
+        keyed.append((title if seen[title] == 1 else f"{title}#{seen[title]}", title, blocks))
+    return keyed
+
+def adopt_chapter_pages(existing):
+    """没有章节子页面记录时（如 chapter_pages.json 丢失），按标题认领书籍页面下已有的子页面
+
+    哈希未知，认领的子页面都会重写；对不上章节的子页面随后被归档
+    """
+    titled = [(block["child_page"].get("title", ""), block["id"])
+              for block in existing if block.get("type") == "child_page"]
+    return {key: {"page_id": block_id, "hash": None} for key, _, block_id in _chapter_keys(titled)}
+
+def write_chapter_pages(page_id, book_id, children, notion_token, max_workers=4, existing=None):
+    """按章节子页面写入书籍内容 - 书籍页面下每个章节一个子页面
+
+    子页面按章节顺序依次创建，保证书籍页面里的子页面顺序就是章节目录；
+    内容并行写入。更新时只重写内容哈希发生变化的章节，删除已不存在的章节。
+    existing 为书籍页面已有的子块，没有该书的记录时从中认领子页面，避免重复创建。
+    """
+    groups = split_children_by_chapter(children)
+    old_state = load_chapter_pages().get(book_id)
+    if old_state is None:
+        old_state = adopt_chapter_pages(existing or [])
+        if old_state:
+            print(f"📑 按标题认领已有的 {len(old_state)} 个章节子页面")
+    new_state = {}
+    to_create, to_rewrite = [], []
+
+    for key, title, blocks in _chapter_keys(groups):
+        digest = _blocks_hash(blocks)
+        old = old_state.get(key)
+        if old and old["hash"] == digest:
+            new_state[key] = old
+        elif old:
+            new_state[key] = {"page_id": old["page_id"], "hash": digest}
+            to_rewrite.append((old["page_id"], blocks))
+        else:
+            to_create.append((key, title, blocks, digest))
+
+    for n, (key, title, blocks, digest) in enumerate(to_create):
+        child_id = create_child_page(page_id, title, notion_token)
+        if not child_id:
+            print(f"❌ 创建章节子页面失败: {title}")
+            # 已创建的子页面记下来（内容未写入，哈希为空），下次运行复用而不是重复创建；
+            # 其余章节保持原来的状态
+            partial = dict(old_state)
+            for created_key, *_ in to_create[:n]:
+                partial[created_key] = {"page_id": new_state[created_key]["page_id"], "hash": None}
+            with _chapter_pages_lock:
+                all_state = load_chapter_pages()
+                all_state[book_id] = partial
+                _write_json_atomic(CHAPTER_PAGES_FILE, all_state)
+            return None
+        new_state[key] = {"page_id": child_id, "hash": digest}
+        to_rewrite.append((child_id, blocks))
+
+    removed = [old["page_id"] for key, old in old_state.items() if key not in new_state]
+    print(f"📑 章节子页面: 新建 {len(to_create)}，重写 {len(to_rewrite) - len(to_create)}，"
+          f"未变化 {len(groups) - len(to_rewrite)}，删除 {len(removed)}")
+
+    def fill(item):
+        child_id, blocks = item
+        if child_id in created_ids:
+            return add_children(child_id, blocks, notion_token) if blocks else True
+        return replace_page_children(child_id, blocks, notion_token, max_workers=1)
+
+    created_ids = {new_state[key]["page_id"] for key, *_ in to_create}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(fill, to_rewrite))
+        list(executor.map(lambda child_id: archive_page(child_id, notion_token), removed))
+
+    # 失败的章节不记录哈希，下次运行重写
+    for (child_id, _), ok in zip(to_rewrite, results):
+        if not ok:
+            for key, entry in new_state.items():
+                if entry["page_id"] == child_id:
+                    entry["hash"] = None
+    with _chapter_pages_lock:
+        all_state = load_chapter_pages()
+        all_state[book_id] = new_state
+        _write_json_atomic(CHAPTER_PAGES_FILE, all_state)
+    return all(results)
+
+def remove_chapter_pages(book_id, notion_token, max_workers=4):
+    """改回直接写在书籍页面时，归档该书所有章节子页面并清除记录"""
+    pages = load_chapter_pages().get(book_id)
+    if pages is None:
+        return True
+    child_ids = [entry["page_id"] for entry in pages.values()]
+    if child_ids:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            archived = list(executor.map(lambda child_id: archive_page(child_id, notion_token), child_ids))
+        if not all(archived):
+            print(f"❌ 归档章节子页面失败: {book_id}")
+            return False
+        print(f"📑 已归档 {len(child_ids)} 个章节子页面，改为直接写入书籍页面")
+    with _chapter_pages_lock:
+        all_state = load_chapter_pages()
+        all_state.pop(book_id, None)
+        _write_json_atomic(CHAPTER_PAGES_FILE, all_state)
+    return True
+
+def load_page_blocks():
+    try:
+        with open(PAGE_BLOCKS_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+_page_blocks_lock = threading.Lock()
+
+def save_page_blocks(book_id, hashes):
+    """记录页面上每个内容块的哈希，下次更新时用于计算增量差异；None表示清除"""
+    with _page_blocks_lock:
+        state = load_page_blocks()
+        if hashes is None:
+            state.pop(book_id, None)
+        else:
+            state[book_id] = hashes
+        _write_json_atomic(PAGE_BLOCKS_FILE, state)
+
+def _append_requests(count):
+    """追加count个块至少需要的请求数（每次最多100个）"""
+    return (count + NOTION_CHILDREN_LIMIT - 1) // NOTION_CHILDREN_LIMIT
+
+def diff_blocks(old_hashes, new_hashes):
+    """新旧块哈希序列的差异 - 返回 (要删除的旧块下标, [(锚点旧块下标, 新块下标列表)])
+
+    两个保留块之间的新块是连续的，作为一组插入到前一个保留块之后；
+    锚点为None表示要插入到页面最前面，Notion API做不到，只能重写
+    """
+    matcher = difflib.SequenceMatcher(None, old_hashes, new_hashes, autojunk=False)
+    deletes, inserts = [], []
+    anchor, pending = None, []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            if pending:
+                inserts.append((anchor, pending))
+                pending = []
+            anchor = i2 - 1
+        else:
+            deletes.extend(range(i1, i2))
+            pending.extend(range(j1, j2))
+    if pending:
+        inserts.append((anchor, pending))
+    return deletes, inserts
+
+def plan_page_update(children, old_hashes, encoded=None):
+    """已存在页面的更新方案 - 比较增量差异和清空重写的请求数，取较少的一种
+
+    返回 {"strategy": "diff"|"rewrite", "ops": {操作: 请求数}, "hashes", "deletes", "inserts"}
+    没有旧块哈希时只能重写，旧块数按新块数估计
+    """
+    if encoded is None:
+        encoded = encode_blocks(children)
+    hashes = _block_hashes(encoded)
+    old_count = len(old_hashes) if old_hashes is not None else len(hashes)
+    list_ops = max(1, _append_requests(old_count))
+    plan = {
+        "strategy": "rewrite",
+        "ops": {"list": list_ops, "delete": old_count, "append": len(chunk_encoded(encoded))},
+        "hashes": hashes,
+    }
+    if old_hashes is None:
+        return plan
+    deletes, inserts = diff_blocks(old_hashes, hashes)
+    if any(anchor is None for anchor, _ in inserts):
+        return plan
+    diff_ops = {"list": list_ops, "delete": len(deletes),
+                "append": sum(len(chunk_encoded([encoded[j] for j in indexes])) for _, indexes in inserts)}
+    if sum(diff_ops.values()) < sum(plan["ops"].values()):
+        plan.update(strategy="diff", ops=diff_ops, deletes=deletes, inserts=inserts)
+    return plan
+
+def apply_block_diff(page_id, children, old_hashes, plan, notion_token, max_workers=4, encoded=None):
+    """按增量差异更新页面 - 只删除变化的块，新块插入到对应位置
+
+    页面上的块和记录的哈希数量对不上（被手动编辑过）时退回清空重写
+    """
+    existing = list_block_children(page_id, notion_token)
+    if existing is None:
+        print(f"❌ 获取页面内容失败: {page_id}")
+        return None
+    blocks = [b for b in existing if b.get("type") != "child_page"]
+    if len(blocks) != len(old_hashes):
+        print("⚠️ 页面内容与记录不一致，改为清空重写")
+        incr_metric("plan_diff_fallback")
+        return replace_page_children(page_id, children, notion_token, max_workers, existing=existing,
+                                     encoded=encoded)
+    for anchor, indexes in plan["inserts"]:
+        if not add_children(page_id, [children[j] for j in indexes], notion_token, after=blocks[anchor]["id"],
+                            encoded=[encoded[j] for j in indexes] if encoded is not None else None):
+            return None
+    delete_ids = [blocks[i]["id"] for i in plan["deletes"]]
+    if delete_ids:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            deleted = list(executor.map(lambda block_id: delete_block(block_id, notion_token), delete_ids))
+        if not all(deleted):
+            print(f"❌ 删除旧内容块失败: {page_id}")
+            return None
+    print(f"✅ 增量更新: 删除 {len(delete_ids)} 个块，插入 {sum(len(i) for _, i in plan['inserts'])} 个块")
+    return True
+
+def wants_chapter_pages(highlight_count, chapter_pages_threshold):
+    """划线数达到阈值的书按章节子页面写入"""
+    return bool(chapter_pages_threshold) and highlight_count >= chapter_pages_threshold
+
+def layout_changed(book_id, highlight_count, chapter_pages_threshold):
+    """写入方式（章节子页面/直接写入）和上次写入时不同 - 内容哈希不包含写入方式，
+    修改 --chapter-pages 后即使内容未变也要重写"""
+    return wants_chapter_pages(highlight_count, chapter_pages_threshold) != (book_id in load_chapter_pages())
+
+def write_book_content(page_id, book_id, children, highlight_count, notion_token, is_new,
+                       chapter_pages_threshold=CHAPTER_PAGES_THRESHOLD, encoded=None):
+    """写入书籍内容 - 划线较多的书按章节子页面写入，否则直接写在书籍页面
+
+    已存在的页面按 plan_page_update 选择增量差异或清空重写
+    """
+    if wants_chapter_pages(highlight_count, chapter_pages_threshold):
+        existing = None
+        if not is_new and book_id not in load_chapter_pages():
+            # 从直接写入改为章节子页面（或记录丢失）: 先清掉页面上原来的目录、标题和划线，子页面留给认领
+            existing = list_block_children(page_id, notion_token)
+            if not clear_page_blocks(page_id, notion_token, existing=existing):
+                return None
+        save_page_blocks(book_id, None)
+        return write_chapter_pages(page_id, book_id, children, notion_token, existing=existing)
+    if not is_new and book_id in load_chapter_pages():
+        # 从章节子页面改回直接写入: 归档子页面，页面内容整体重写
+        if not remove_chapter_pages(book_id, notion_token):
+            return None
+        save_page_blocks(book_id, None)
+    if encoded is None:
+        encoded = encode_blocks(children)
+    if is_new:
+        results = add_children(page_id, children, notion_token, encoded=encoded)
+        hashes = _block_hashes(encoded)
+    else:
+        old_hashes = load_page_blocks().get(book_id)
+        plan = plan_page_update(children, old_hashes, encoded)
+        incr_metric(f"plan_{plan['strategy']}")
+        hashes = plan["hashes"]
+        if plan["strategy"] == "diff":
+            results = apply_block_diff(page_id, children, old_hashes, plan, notion_token, encoded=encoded)
+        else:
+            results = replace_page_children(page_id, children, notion_token, encoded=encoded)
+    save_page_blocks(book_id, hashes if results else None)
+    return results
+
+def plan_book(job, chapter_pages_threshold):
+    """一本书的操作计划 - 返回 {"title", "action", "ops": {操作: 请求数}}，不发送任何Notion请求"""
+    review_count = job["book"].get("reviewCount", 0)
+    review_pages = max(1, (review_count + WEREAD_REVIEW_PAGE_SIZE - 1) // WEREAD_REVIEW_PAGE_SIZE)
+    # 划线列表 + 笔记分页 + 章节信息 + 阅读进度
+    ops = {"weread": 3 + review_pages, "create": 0, "list": 0, "delete": 0, "append": 0, "patch": 1}
+    children = job.get("children")
+    if (job["existing_page_id"] and job["content_hash"] == job["stored_hash"] and not job.get("force")
+            and not layout_changed(job["book_id"], job["highlight_count"], chapter_pages_threshold)):
+        return {"title": job["title"], "action": "properties", "ops": ops}
+    chapter_pages = load_chapter_pages() if job["existing_page_id"] else {}
+    if wants_chapter_pages(job["highlight_count"], chapter_pages_threshold):
+        old_state = chapter_pages.get(job["book_id"], {})
+        if job["existing_page_id"] and job["book_id"] not in chapter_pages:
+            # 改为章节子页面，先清空页面上原来的内容
+            old_count = len(load_page_blocks().get(job["book_id"]) or [])
+            ops["list"] += max(1, _append_requests(old_count))
+            ops["delete"] += old_count
+        keys = set()
+        for key, _, blocks in _chapter_keys(split_children_by_chapter(children)):
+            keys.add(key)
+            old = old_state.get(key)
+            if old and old["hash"] == _blocks_hash(blocks):
+                continue
+            if old:
+                ops["list"] += 1
+                ops["delete"] += len(blocks)
+            else:
+                ops["create"] += 1
+            ops["append"] += _append_requests(len(blocks))
+        ops["patch"] += len(set(old_state) - keys)
+        action = "chapter_pages"
+    elif not job["existing_page_id"]:
+        ops["append"] += len(chunk_encoded(job.get("encoded") or encode_blocks(children)))
+        action = "create"
+    else:
+        old_hashes = load_page_blocks().get(job["book_id"])
+        if job["book_id"] in chapter_pages:
+            # 改回直接写入，归档所有章节子页面后整体重写
+            ops["patch"] += len(chapter_pages[job["book_id"]])
+            old_hashes = None
+        plan = plan_page_update(children, old_hashes, job.get("encoded"))
+        for name, count in plan["ops"].items():
+            ops[name] += count
+        action = plan["strategy"]
+    if not job["existing_page_id"]:
+        ops["create"] += 1
+    return {"title": job["title"], "action": action, "ops": ops}
+
+def print_sync_plan(plans, unchanged, fetch_workers):
+    """输出 --dry-run 的计划和估算的请求数、耗时"""
+    totals = {}
+    print("\n🧭 同步计划:")
+    for plan in plans:
+        notion_requests = sum(count for name, count in plan["ops"].items() if name != "weread")
+        print(f"   {plan['title']}: {plan['action']}，Notion 请求 {notion_requests}，WeRead 请求 {plan['ops']['weread']}")
+        for name, count in plan["ops"].items():
+            totals[name] = totals.get(name, 0) + count
+    notion_total = sum(count for name, count in totals.items() if name != "weread")
+    weread_total = totals.get("weread", 0)
+    # 抓取和写入在流水线中并行，耗时取两者中较长的一个
+    seconds = max(notion_total / NOTION_RATE_LIMIT, weread_total * WEREAD_REQUEST_SECONDS / max(1, fetch_workers))
+    print(f"🧭 需要同步 {len(plans)} 本，未变化 {unchanged} 本")
+    print(f"🧭 操作合计: {totals}")
+    print(f"🧭 预计 Notion 请求 {notion_total} 次（限流 {NOTION_RATE_LIMIT:g}/s），WeRead 请求 {weread_total} 次，"
+          f"预计耗时约 {seconds:.0f}s")
+    return {"books": len(plans), "unchanged": unchanged, "ops": totals,
+            "notion_requests": notion_total, "weread_requests": weread_total, "seconds": seconds}
+
+def save_book_snapshot(book_id, marker, chapter, bookmark_list, summary, reviews):
+    """保存本次抓取到的书籍数据，供 rerender 离线重建页面"""
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    path = os.path.join(SNAPSHOT_DIR, f"{book_id}.json.gz")
+    snapshot = {
+        "book_id": book_id,
+        "marker": marker,
+        "chapter": chapter,
+        "bookmark_list": bookmark_list,
+        "summary": summary,
+        "reviews": reviews,
+    }
+    with gzip.open(f"{path}.tmp", "wt", encoding="utf-8") as f:
+        json.dump(snapshot, f, ensure_ascii=False)
+    os.replace(f"{path}.tmp", path)
+
+def load_book_snapshot(book_id):
+    path = os.path.join(SNAPSHOT_DIR, f"{book_id}.json.gz")
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def list_snapshot_book_ids():
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return []
+    return sorted(name[:-len(".json.gz")] for name in os.listdir(SNAPSHOT_DIR) if name.endswith(".json.gz"))
+
 def get_children(chapter,bookmark_list, summary,reviews):
     children = []
     grandchild = {}
@@ -818,11 +2196,8 @@ def get_children(chapter,bookmark_list, summary,reviews):
                     
                                 
     # print(f"组合📚====--: {chapter_data}")
-    # 按章节索引排序
-    sorted_chapters = sorted(chapter_data.items(), key=lambda x: x[1]["chapterIdx"])
-    
-    # 处理每个章节
-    for chapterUid, chapter_info in sorted_chapters:
+    # bookmark_list 已经由 merge_highlights 按章节顺序排好，按出现顺序处理每个章节
+    for chapterUid, chapter_info in chapter_data.items():
         # 添加章节标题
        
         chapter_title = chapter_info["chapterName"]
@@ -856,7 +2231,7 @@ def get_children(chapter,bookmark_list, summary,reviews):
                 quote = get_quote(
                 rev.get("content","")
             )
-            children.append(quote)
+                children.append(quote)
          # # 添加该章节下的所有【划线评论】
         
         # for review in chapter_info["reviews"]:
@@ -920,192 +2295,875 @@ def get_children(chapter,bookmark_list, summary,reviews):
     print(f"✅ 最终生成的=== :{children}")
     return children, grandchild
 
-def main(weread_token, notion_token, database_id):
+class PipelineStage:
+    """流水线的一个阶段 - func(job) 返回处理后的job，返回None表示该job到此为止"""
+
+    def __init__(self, name, func, workers=1, queue_size=4):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.busy_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.processed = 0
+        self.max_depth = 0
+
+    def record(self, busy, blocked):
+        with self.lock:
+            self.busy_seconds += busy
+            self.blocked_seconds += blocked
+            self.processed += 1
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+
+_PIPELINE_DONE = object()
+
+def run_pipeline(source, stages, stop_event, on_error):
+    """用有界队列把各阶段串起来运行
+
+    source 在单独线程中产出job；队列满时上游阻塞（背压），所以内存峰值只取决于队列深度。
+    stop_event 置位后不再处理新的job。结束后输出各阶段利用率，利用率最高的就是瓶颈。
+    """
+    started = time.monotonic()
+
+    def feed():
+        try:
+            for job in source:
+                if stop_event.is_set():
+                    break
+                stages[0].queue.put(job)
+        finally:
+            for _ in range(stages[0].workers):
+                stages[0].queue.put(_PIPELINE_DONE)
+
+    def work(index):
+        stage = stages[index]
+        next_stage = stages[index + 1] if index + 1 < len(stages) else None
+        while True:
+            job = stage.queue.get()
+            if job is _PIPELINE_DONE:
+                return
+            if stop_event.is_set():
+                continue
+            t0, cpu0 = time.monotonic(), time.thread_time()
+            parent = job.get("span") if isinstance(job, dict) else None
+            try:
+                with tracer.span(stage.name, parent=parent):
+                    result = stage.func(job)
+            except Exception as e:
+                on_error(job, f"{stage.name}: {e}")
+                result = None
+            t1 = time.monotonic()
+            add_stage_time(stage.name, t1 - t0, time.thread_time() - cpu0)
+            if result is not None and next_stage is not None:
+                next_stage.queue.put(result)
+            stage.record(t1 - t0, time.monotonic() - t1)
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    stage_threads = []
+    for index, stage in enumerate(stages):
+        stage_threads.append([threading.Thread(target=work, args=(index,), daemon=True) for _ in range(stage.workers)])
+    for t in threads + [t for group in stage_threads for t in group]:
+        t.start()
+    threads[0].join()
+    # 上一阶段的线程全部结束后，再通知下一阶段结束
+    for index, group in enumerate(stage_threads):
+        for t in group:
+            t.join()
+        if index + 1 < len(stages):
+            for _ in range(stages[index + 1].workers):
+                stages[index + 1].queue.put(_PIPELINE_DONE)
+
+    wall = max(time.monotonic() - started, 1e-9)
+    print("📊 流水线阶段利用率:")
+    for stage in stages:
+        utilisation = stage.busy_seconds / (wall * stage.workers)
+        print(f"   {stage.name}: 处理 {stage.processed}，线程 {stage.workers}，利用率 {utilisation:.0%}，"
+              f"下游阻塞 {stage.blocked_seconds:.1f}s，队列峰值 {stage.max_depth}")
+        with _metrics_lock:
+            RUN_METRICS[f"stage_{stage.name}"] = {
+                "processed": stage.processed,
+                "workers": stage.workers,
+                "utilisation": round(utilisation, 3),
+                "blocked_seconds": round(stage.blocked_seconds, 2),
+            }
 
-    """主函数 - 添加错误处理和提前退出"""
+def chapter_order(chapter):
+    """章节UID → 章节序号(chapterIdx)，来自 get_chapter_info"""
+    return {uid: info.get("chapterIdx", 0) for uid, info in (chapter or {}).items()}
+
+def highlight_key(item, order):
+    """划线/想法的整数排序键 - 章节序号在高32位，划线起始位置在低32位
+
+    没有章节信息时退回用 chapterUid 作为章节序号
+    """
+    uid = item.get("chapterUid", 1)
+    chapter_idx = order.get(uid, uid) if order else uid
+    text = item.get("range") or ""
+    dash = text.find("-")
+    start = text[:dash] if dash >= 0 else text
+    return (int(chapter_idx or 0) << 32) | (int(start) if start.isdigit() else 0)
+
+def merge_highlights(bookmarks, reviews, chapter=None):
+    """划线和想法合并成按 (章节序号, 划线位置) 排好序的一个列表
+
+    每条只解析一次整数键；两路各自排序（接口返回的数据基本有序，Timsort 接近线性），
+    再线性归并
+    """
+    order = chapter_order(chapter)
+    streams = []
+    for items in (bookmarks, reviews):
+        keyed = [(highlight_key(item, order), item) for item in items]
+        keyed.sort(key=itemgetter(0))
+        streams.append(keyed)
+    return [item for _, item in heapq.merge(*streams, key=itemgetter(0))]
+
+def sort_bookmarks(bookmark_list, chapter=None):
+    """按章节和划线位置排序"""
+    return merge_highlights(bookmark_list, [], chapter)
+
+def fetch_book(session, job, weread_token, save_snapshot=True):
+    """抓取阶段 - 获取划线、笔记和章节信息"""
+    book_id = job["book_id"]
+    print(f"📝 获取划线列表: {job['title']}")
+    http_cache.track_start()
+    try:
+        bookmarks = get_bookmark_list(session, book_id, weread_token)
+        if bookmarks is None:
+            # 不能把空列表写进页面覆盖原有的划线
+            raise RuntimeError("获取划线列表失败")
+        summary, reviews = get_review_list(session, book_id, weread_token)
+        chapter = get_chapter_info(session, book_id, weread_token)
+        read_info = get_read_info(session, book_id)
+    finally:
+        # 所有响应都和上次成功写入时一致时，渲染和写入都可以跳过
+        hashes = http_cache.track_end()
+        job["response_hashes"] = hashes if weread_http_cache is not None else None
+    bookmark_list = merge_highlights(bookmarks, reviews, chapter)
+    if save_snapshot:
+        save_book_snapshot(book_id, job["marker"], chapter, bookmark_list, summary, reviews)
+    job.update(chapter=chapter, bookmark_list=bookmark_list, summary=summary, reviews=reviews,
+               read_info=read_info, read_properties=get_read_properties(read_info))
+    return job
+
+def render_book(job, chapter_pages_threshold=CHAPTER_PAGES_THRESHOLD):
+    """渲染阶段 - 生成Notion内容块"""
+    # 本地镜像需要内容块，只有Notion需要写入时才能跳过渲染
+    only_notion = all(sink.name == "notion" for sink in job.get("sinks", []))
+    written_hash = (weread_http_cache.written_content_hash(job["book_id"], job.get("response_hashes"))
+                    if weread_http_cache is not None else None)
+    # 页面上的内容必须正是上次写入的那一份，否则仍需重新渲染
+    if (written_hash and written_hash == job["stored_hash"] and job["existing_page_id"] and only_notion
+            and not job.get("force")
+            and not layout_changed(job["book_id"], len(job["bookmark_list"]), chapter_pages_threshold)):
+        print(f"ℹ️ WeRead 响应与上次写入时一致，跳过渲染: {job['title']}")
+        incr_metric("books_render_skipped")
+        job["content_hash"] = written_hash
+        job["highlight_count"] = len(job.pop("bookmark_list"))
+        return job
+    children, grandchild = get_children(job["chapter"], job["bookmark_list"], job["summary"], job["reviews"])
+    if not children:
+        raise ValueError("没有生成任何内容块")
+    print(f"✅ 成功生成 {len(children)} 个内容块: {job['title']}")
+    job["children"] = children
+    # 每个块只编码一次，哈希、分块和请求体都使用同一份字节
+    job["encoded"] = encode_blocks(children)
+    job["content_hash"] = _encoded_hash(job["encoded"])
+    # 后续阶段不再需要原始数据，尽早释放
+    for key in ("chapter", "summary", "reviews"):
+        job.pop(key, None)
+    job["highlight_count"] = len(job.pop("bookmark_list"))
+    return job
+
+def write_book(session, job, database_id, notion_token, chapter_pages_threshold, write_buffer):
+    """写入阶段 - 创建或更新Notion页面，成功后写入摘要
+
+    已存在页面的阅读进度和摘要放进 write_buffer，页面写完后合并成一次PATCH
+    """
+    title, book_id, book = job["title"], job["book_id"], job["book"]
+    page_id = job["existing_page_id"]
+    if page_id:
+        write_buffer.set(page_id, job["read_properties"])
+        if (job["content_hash"] == job["stored_hash"] and not job.get("force")
+                and not layout_changed(book_id, job["highlight_count"], chapter_pages_threshold)):
+            # 只是标记变化，内容没变
+            print(f"ℹ️ 内容未变化，只更新属性: {title}")
+            results = True
+        else:
+            print(f"📚 为已存在书籍更新内容: {title}")
+            results = write_book_content(page_id, book_id, job["children"], job["highlight_count"],
+                                         notion_token, is_new=False,
+                                         chapter_pages_threshold=chapter_pages_threshold,
+                                         encoded=job.get("encoded"))
+    else:
+        print(f"🔄 创建Notion页面: {title}")
+        page_id = insert_to_notion(session, title, book_id, book.get('cover', 'no'), job["sort"],
+                                   book.get('author', '未知'), database_id, notion_token,
+                                   read_properties=job["read_properties"])
+        if not page_id:
+            raise RuntimeError("创建Notion页面失败")
+        results = write_book_content(page_id, book_id, job["children"], job["highlight_count"],
+                                     notion_token, is_new=True,
+                                     chapter_pages_threshold=chapter_pages_threshold, encoded=job.get("encoded"))
+    if not results:
+        raise RuntimeError("写入页面内容失败")
+    save_book_digest(page_id, job["marker"], job["content_hash"], database_id, notion_token, write_buffer)
+    if not write_buffer.flush(page_id):
+        raise RuntimeError("更新页面属性失败")
+    print(f"✅ 成功同步书籍: {title}")
+    return job
+
+def _book_field(book, name):
+    """书架条目的字段 - 兼容平铺和嵌套在 book 中的两种结构"""
+    value = book.get(name)
+    return value if value is not None else (book.get("book") or {}).get(name)
+
+def filter_books(books, book=None, since=None, category=None):
+    """按 --book / --since / --category 筛选书架，在调度任何抓取之前执行
+
+    book: BookId 或书名列表；since: "YYYY-MM-DD"，按笔记本的更新时间(sort)筛选；
+    category: 分类名称包含该文字即可
+    """
+    selected = books
+    if book:
+        wanted = set(book)
+        selected = [b for b in selected if b.get("bookId") in wanted or _book_field(b, "title") in wanted]
+    if since:
+        since_ts = datetime.strptime(since, "%Y-%m-%d").timestamp()
+        selected = [b for b in selected if (b.get("sort") or 0) >= since_ts]
+    if category:
+        def matches(b):
+            names = [_book_field(b, "category") or ""]
+            names += [c.get("title", "") for c in _book_field(b, "categories") or []]
+            return any(category in name for name in names)
+        selected = [b for b in selected if matches(b)]
+    return selected
+
+def filter_by_status(books, notion_index, status):
+    """按 --status 筛选 - 状态取自数据库索引中的 Status 属性，还没有页面的书状态未知，不选"""
+    def book_status(b):
+        entry = (notion_index or {}).get(b.get("bookId"))
+        prop = entry["properties"].get("Status") if entry else None
+        if not prop:
+            return None
+        return ((prop.get(prop.get("type")) or {}).get("name"))
+    return [b for b in books if book_status(b) == status]
+
+def shelf_digest(books):
+    """书架的稳定摘要 - 每本书的变化标记按BookId排序后哈希，与书架顺序无关"""
+    lines = sorted(f"{b.get('bookId')}={notebook_marker(b)}" for b in books)
+    return hashlib.sha1("\n".join(lines).encode("utf-8")).hexdigest()
+
+def load_shelf_digest():
+    try:
+        with open(SHELF_DIGEST_FILE, "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def save_shelf_digest(digest):
+    os.makedirs(SYNC_STATE_DIR, exist_ok=True)
+    with open(f"{SHELF_DIGEST_FILE}.tmp", "w", encoding="utf-8") as f:
+        f.write(digest)
+    os.replace(f"{SHELF_DIGEST_FILE}.tmp", SHELF_DIGEST_FILE)
+
+def probe(weread_token):
+    """只请求一次笔记本列表，和上次完整同步成功时的书架摘要比较
+
+    返回退出码: 有变化或无法判断时 0（需要同步），没有变化时 PROBE_UNCHANGED_EXIT。
+    在 GitHub Actions 中同时写入 changed=true/false 到 $GITHUB_OUTPUT
+    """
+    session = requests.Session()
+    session.cookies.update(parse_cookie_string(weread_token))
+    response = weread_request(session, "GET", WEREAD_NOTEBOOKS_URL, headers=get_headers(weread_token))
+    stored = load_shelf_digest()
+    changed = True
+    if response is None or response.status_code != 200:
+        print("⚠️ 获取笔记本列表失败，按有变化处理")
+    else:
+        try:
+            data = response.json()
+        except ValueError:
+            data = {"errCode": "invalid_json"}
+        if "books" not in data:
+            print(f"⚠️ 笔记本列表响应异常，按有变化处理: errCode={data.get('errCode')}")
+        else:
+            digest = shelf_digest(data["books"])
+            changed = digest != stored
+            print(f"🔍 书架 {len(data['books'])} 本，摘要 {digest[:12]}，上次同步 {(stored or '无')[:12]}")
+    print("🔔 有变化，需要同步" if changed else "💤 没有变化，跳过同步")
+    output = os.environ.get("GITHUB_OUTPUT")
+    if output:
+        with open(output, "a", encoding="utf-8") as f:
+            f.write(f"changed={'true' if changed else 'false'}\n")
+    return 0 if changed else PROBE_UNCHANGED_EXIT
+
+class NotionSink:
+    """Notion 输出 - 与 local_sinks 中的本地输出接口一致: is_current(book_id, marker) / write(job) / save()"""
+
+    name = "notion"
+
+    def __init__(self, session, database_id, notion_token, notion_index, write_buffer, chapter_pages_threshold):
+        self.session = session
+        self.database_id = database_id
+        self.notion_token = notion_token
+        self.notion_index = notion_index
+        self.write_buffer = write_buffer
+        self.chapter_pages_threshold = chapter_pages_threshold
+
+    def lookup(self, book_id):
+        """返回 (已存在的页面ID, 已存储的变化标记, 已存储的内容哈希)；没有索引时逐本查询"""
+        if self.notion_index is None:
+            return check(book_id, self.database_id, self.notion_token), None, None
+        entry = self.notion_index.get(book_id)
+        if not entry:
+            return None, None, None
+        return (entry["page_id"], *split_digest(entry["digest"]))
+
+    def is_current(self, book_id, marker):
+        page_id, stored_marker, _ = self.lookup(book_id)
+        return bool(page_id and stored_marker == marker)
+
+    def write(self, job):
+        write_book(self.session, job, self.database_id, self.notion_token, self.chapter_pages_threshold,
+                   self.write_buffer)
+        return True
+
+    def save(self):
+        # 写入失败的书籍，已缓冲的阅读进度仍然发送（摘要不会进入缓冲，下次运行会重试内容）
+        self.write_buffer.flush_all()
+
+def create_local_sinks(mirrors):
+    """按 {"markdown": 目录, "jsonl": 目录} 创建本地输出"""
+    sink_types = {"markdown": MarkdownSink, "jsonl": JsonlSink}
+    return [sink_types[kind](out_dir) for kind, out_dir in (mirrors or {}).items() if out_dir]
+
+def _finished_month(read_info):
+    if read_info.get("markedStatus") == 4 and read_info.get("finishedDate"):
+        return datetime.utcfromtimestamp(read_info["finishedDate"]).strftime("%Y-%m")
+    return None
+
+def progress_marker(book):
+    """书架条目中的阅读进度标记 - 阅读更新时间和进度，书架没有这些字段时为空（不刷新进度）"""
+    values = [_book_field(book, name) for name in ("readUpdateTime", "progress", "readingProgress", "finishReading")]
+    return ":".join("" if v is None else str(v) for v in values) if any(v is not None for v in values) else ""
+
+def record_reading_stats(reading_stats, job):
+    """同步成功的书籍计入阅读统计"""
+    reading_stats.mark_progress(job["book_id"], progress_marker(job["book"]))
+    read_info = job.get("read_info") or {}
+    highlights = job.get("highlight_count", len(job.get("bookmark_list") or []))
+    reading_stats.record(job["book_id"], job["title"], read_info.get("readingTime", 0),
+                         _finished_month(read_info), highlights)
+
+def parse_reading_time(text):
+    """get_read_properties 写入的 "X时Y分" 转回秒数"""
+    match = re.fullmatch(r"(?:(\d+)时)?(?:(\d+)分)?", (text or "").strip())
+    if not match:
+        return 0
+    return int(match.group(1) or 0) * 3600 + int(match.group(2) or 0) * 60
+
+def seed_reading_stats(reading_stats, books, notion_index):
+    """为统计中还没有的书补种贡献 - 阅读时长、读完日期取自数据库索引，划线数取自书架，不发送请求
+
+    已按摘要跳过的书和本地状态丢失后的首次运行都靠这里计入总计
+    """
+    seeded = 0
+    for book in books:
+        entry = (notion_index or {}).get(book.get("bookId"))
+        if not entry:
+            continue
+        properties = entry["properties"]
+        status = properties.get("Status") or {}
+        end_date = (properties.get("EndDate") or {}).get("date") or {}
+        finished = (status.get(status.get("type")) or {}).get("name") == "读完"
+        seeded += reading_stats.seed(
+            book["bookId"], _book_field(book, "title") or "",
+            parse_reading_time(_rich_text_plain(properties.get("ReadingTime"))),
+            (end_date.get("start") or "")[:7] or None if finished else None,
+            book.get("noteCount", 0) + book.get("reviewCount", 0))
+    if seeded:
+        print(f"📊 阅读统计补种 {seeded} 本书")
+    return seeded
+
+def refresh_reading_progress(session, reading_stats, write_buffer, unchanged, workers=2):
+    """没有新笔记、但书架上阅读进度有变化的书只请求阅读进度 - 阅读时长计入统计，进度属性放进 write_buffer
+
+    unchanged: [(BookId, 书名, 页面ID, 进度标记)]；请求数与进度有变化的书数成正比，与书架大小无关
+    """
+    def refresh(item):
+        book_id, title, page_id, marker = item
+        read_info = get_read_info(session, book_id)
+        if not read_info:
+            return False
+        reading_stats.update_progress(book_id, title, read_info.get("readingTime", 0), _finished_month(read_info))
+        reading_stats.mark_progress(book_id, marker)
+        write_buffer.set(page_id, get_read_properties(read_info))
+        return True
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(executor.map(refresh, unchanged))
+    incr_metric("progress_refreshed", sum(results))
+    return sum(results)
+
+def _dashboard_blocks(reading_stats):
+    """看板页面的固定结构 - 块的数量和顺序不变，更新时只改有变化的段落"""
+    overview, monthly, ranking = reading_stats.summary_lines()
+    sections = [
+        ("heading_2", "📊 阅读统计"), ("paragraph", "\n".join(overview)),
+        ("heading_3", "每月读完"), ("paragraph", "\n".join(monthly)),
+        ("heading_3", "划线最多的书"), ("paragraph", "\n".join(ranking)),
+    ]
+    return [(block_type, text[:NOTION_TEXT_LIMIT]) for block_type, text in sections]
+
+def _text_block(block_type, text):
+    return {"type": block_type, block_type: {"rich_text": [{"type": "text", "text": {"content": text}}]}}
+
+def update_dashboard(page_id, reading_stats, notion_token):
+    """更新阅读统计看板 - 首次追加固定结构的块，之后只PATCH文本有变化的块
+
+    每次运行的请求数与书籍数量无关，最多等于看板的块数
+    """
+    sections = _dashboard_blocks(reading_stats)
+    state = reading_stats.dashboard
+    blocks = state.get("blocks") or []
+    if state.get("page_id") != page_id or len(blocks) != len(sections):
+        response = notion_api_request("PATCH", f"/blocks/{page_id}/children",
+                                      {"children": [_text_block(t, text) for t, text in sections]}, notion_token)
+        if not response:
+            print("❌ 创建阅读统计看板失败")
+            return False
+        reading_stats.dashboard = {
+            "page_id": page_id,
+            "blocks": [{"id": block["id"], "text": text}
+                       for block, (_, text) in zip(response.get("results", []), sections)],
+        }
+        incr_metric("dashboard_requests")
+        print("✅ 已创建阅读统计看板")
+        return True
+
+    updated = 0
+    for block, (block_type, text) in zip(blocks, sections):
+        if block["text"] == text:
+            continue
+        response = notion_api_request("PATCH", f"/blocks/{block['id']}", _text_block(block_type, text), notion_token)
+        incr_metric("dashboard_requests")
+        if not response:
+            # 块可能被手动删除，下次运行重新创建
+            print("⚠️ 更新阅读统计看板失败，下次运行时重新创建")
+            reading_stats.dashboard = {}
+            return False
+        block["text"] = text
+        updated += 1
+    print(f"✅ 阅读统计看板已更新 {updated} 个块")
+    return True
+
+def main(weread_token, notion_token, database_id, chapter_pages_threshold=CHAPTER_PAGES_THRESHOLD,
+         fetch_workers=2, render_workers=1, write_workers=2, queue_size=4, max_errors=1,
+         dashboard_page_id=DASHBOARD_PAGE_ID, dry_run=False, filters=None, mirrors=None, lease=None):
+
+    """主函数 - 书架 → 抓取 → 渲染 → 写入 四个阶段通过有界队列组成流水线
+
+    返回 {"success": 成功数, "error": 失败数, "total": 书架总数}，中途无法继续时返回None
+    dry_run 时用计划阶段代替写入阶段，不修改Notion和本地状态，返回计划汇总（含失败数 error）
+    filters: {"book", "since", "category", "status"}，只同步选中的书
+    mirrors: {"markdown": 目录, "jsonl": 目录}，同一次抓取和渲染同时写入本地镜像
+    lease: 运行级租约，被其他运行接管后停止写入
+    """
     try:
         # # 初始化session和Notion API
         session = requests.Session()
         session.cookies.update(parse_cookie_string(weread_token))
-        
+        init_http_cache(read_only=dry_run)
 
-        latest_sort = get_sort(database_id, notion_token)
+        with stage_timer("sort"):
+            latest_sort = get_sort(database_id, notion_token)
         if latest_sort is None:
             print("获取排序值失败，停止同步")
             exit(1)
 
         # 获取微信读书书架
-        bookshelf = get_bookshelf(session,weread_token)
+        with stage_timer("shelf"):
+            bookshelf = get_bookshelf(session,weread_token)
         if not bookshelf:
             print(" 获取书架失败，停止同步")
             return
 
         books = bookshelf.get('books', [])
+        digest = shelf_digest(books)
+        filters = {k: v for k, v in (filters or {}).items() if v}
+        shelf_total = len(books)
+        books = filter_books(books, filters.get("book"), filters.get("since"), filters.get("category"))
+
+        # 一次性读取数据库索引，对比摘要判断哪些书需要同步；有筛选条件时只查询选中的书
+        with stage_timer("notion_index"):
+            if not dry_run:
+                ensure_digest_property(database_id, notion_token)
+            selected_ids = [b.get("bookId") for b in books if b.get("bookId")] if filters else None
+            notion_index = load_notion_index(database_id, notion_token, selected_ids, persist=not dry_run)
+        if filters.get("status"):
+            books = filter_by_status(books, notion_index, filters["status"])
+        if filters:
+            print(f"🔎 筛选条件 {filters}: 选中 {len(books)}/{shelf_total} 本")
+
+        # 同一页面的属性更新合并发送，与索引中相同的值不再写入
+        stored = {e["page_id"]: e["properties"] for e in (notion_index or {}).values()}
+        write_buffer = PageWriteBuffer(database_id, notion_token, stored)
+        notion_sink = NotionSink(session, database_id, notion_token, notion_index, write_buffer,
+                                 chapter_pages_threshold)
+        local_sinks = create_local_sinks(mirrors)
+        # 本地输出和Notion写入并行
+        sink_executor = ThreadPoolExecutor(max_workers=max(1, len(local_sinks)), thread_name_prefix="sink")
+        # 阅读统计按本次同步的书籍增量更新；跳过的书从书架和索引补种，只更新阅读进度
+        reading_stats = ReadingStats(READING_STATS_FILE)
+        if not dry_run:
+            seed_reading_stats(reading_stats, books, notion_index)
+        unchanged_books = []
 
         # 5. 同步书籍到Notion - 整合完整功能
-        success_count = 0
-        error_count = 0
-        max_errors = 1  # 最大错误次数
-        
-        for i, book in enumerate(books):
-            # 原有的书籍基本信息处理
-            book_id = book.get('bookId')
-            cover = 'http'
-            if book.get('cover'):
-                cover = book.get('cover')
-            sort = book["sort"]
-            author = book.get("author")
-            if not book_id:
-                print("❌ 书籍ID缺失,跳过")
-                error_count += 1
-                if error_count >= max_errors:
+        counts = {"success": 0, "error": 0}
+        counts_lock = threading.Lock()
+        # 最大错误次数
+        stop_event = threading.Event()
+
+        def on_error(job, message):
+            print(f"❌ 处理书籍失败: {job.get('title') if job else ''} - {message}")
+            if job and job.get("span"):
+                job["span"].end(status="error", error=truncate(message))
+            with counts_lock:
+                counts["error"] += 1
+                if counts["error"] >= max_errors and not stop_event.is_set():
                     print("❌ 错误次数超过限制，停止同步")
-                    break
-                continue
-                
-            title = book.get('title', '未知标题')
-            print(f"📚书名==: {title}")
-            print(f"\n正在处理 [{i+1}/{len(books)}]: {title}")
-            
-            # 检查书籍是否已存在
-            existing_page_id = check(book_id, database_id, notion_token)
-            return
-            try:
-                if existing_page_id:
-                    # 更新现有书籍 - 同时添加或更新内容
-                    latest_sort += 1
-                    
-                    # 获取详细数据用于更新内容
+                    stop_event.set()
 
-                    bookmark_list = get_bookmark_list(session,book_id,weread_token)                    
-                    summary, reviews = get_review_list(session,book_id,weread_token)
-                    bookmark_list.extend(reviews)
-                    
-                    # 排序内容
-                    bookmark_list = sorted(bookmark_list, key=lambda x: (
-                        x.get("chapterUid", 1), 
-                        0 if x.get("range", "") == "" else int(x.get("range").split("-")[0])
-                    ))
-                    # 2. 获取该页面上已存在的笔记ID
-                    existing_note_ids = get_existing_note_ids(notion_token, existing_page_id)
-                    print(f"🔄 书籍已存在ID,更新内容: {existing_note_ids}")
-                    
-                    # 构建内容
+        # 书架阶段在单独线程中运行，这里记下运行级别的 span 作为每本书的父 span
+        run_span = tracer.current()
 
-                    children, grandchild = get_children(bookmark_list, summary, reviews)
-                    
-                    # 检查是否有内容生成
-                    if not children:
-                        print(f"❌ 没有生成任何内容块，跳过书籍: {title}")
-                        error_count += 1
-                        if error_count >= max_errors:
-                            print("❌ 错误次数超过限制，停止同步")
-                            break
-                        continue
-                    
-                    print(f"✅ 成功生成 :{grandchild}")
-
-                    results = add_children(existing_page_id, children,notion_token)
-
-                    # 然后添加内容
-                    print(f"📚 为已存在书籍添加内容...")
-                    if not results:
-                        print(f"❌ 为已存在书籍添加内容失败: {title}")
-                        error_count += 1
-                        if error_count >= max_errors:
-                            print("❌ 错误次数超过限制，停止同步")
-                            break
-                        continue
-                        
-                    success_count += 1
-                    print(f"✅ 成功更新书籍内容: {title}")
-                   
-                  
-                else:
-                    # 新增完整功能：获取详细数据并创建完整页面
-                    latest_sort += 1
-                 
-                    
-                    # 获取划线列表
-                    print(f"📝 获取划线列表...")
-                    bookmark_list = get_bookmark_list(session,book_id,weread_token)                    
-                    summary, reviews = get_review_list(session,book_id,weread_token)
-                    bookmark_list.extend(reviews)
-                    chapter = get_chapter_info(session,book_id,weread_token)
-                    # 排序内容
-                    bookmark_list = sorted(bookmark_list, key=lambda x: (
-                        x.get("chapterUid", 1), 
-                        0 if x.get("range", "") == "" else int(x.get("range").split("-")[0])
-                    ))
-                    # 2. 获取该页面上已存在的笔记ID
-                    # existing_note_ids = get_existing_note_ids(notion_token, existing_page_id)
-                    # print(f"🔄 书籍已存在ID,更新内容: {existing_note_ids}")
-                    
-                    # 构建内容
-
-                    children, grandchild = get_children(chapter,bookmark_list, summary, reviews)
-                    # 检查是否有内容生成
-                    if not children:
-                        print(f"❌ 没有生成任何内容块，跳过书籍: {title}")
-                        error_count += 1
-                        if error_count >= max_errors:
-                            print("❌ 错误次数超过限制，停止同步")
-                            break
-                        continue
-
-                    print(f"✅ 成功生成 {len(children)} 个内容块")
-
-                    # 创建Notion页面 - 使用原有的add_book_to_notion函数
-                    print(f"🔄 创建Notion页面...")
-                    page_id = insert_to_notion(session,title, book_id, book.get('cover', 'no'), latest_sort, 
-                                            book.get('author', '未知') , database_id, notion_token)
-                    if not page_id:
-                        print(f"❌ 创建Notion页面失败: {title}")
-                        error_count += 1
-                        if error_count >= max_errors:
-                            print("❌ 错误次数超过限制，停止同步")
-                        break
-
-                    # 添加详细内容（目录、笔记、划线等）
-                    print(f"📚 添加详细内容...")
-                    if children:  # 只有在有内容时才添加
-                        results = add_children(page_id, children, notion_token)
-                        if not results:
-                            print(f"⚠️ 添加子内容失败: {title}，但书籍页面已创建")
-                    else:
-                        print(f"ℹ️ 没有找到章节或笔记内容: {title}")
-
-                    success_count += 1
-                    print(f"✅ 成功添加完整书籍: {title}")
-                
-                # 检查错误计数
-                if error_count >= max_errors:
-                    print("❌ 错误次数超过限制，停止同步")
-                    break
-                    
-            except Exception as e:
-                error_count += 1
-                print(f"❌ 处理书籍时发生异常: {title} - {e}")
-                if error_count >= max_errors:
-                    print("❌ 错误次数超过限制，停止同步")
-                    break
-            
-            # 避免请求过于频繁
-            time.sleep(1)
+        force = bool(filters.get("book"))
+
+        def shelf_jobs():
+            """书架阶段 - 过滤未变化的书，生成待同步的job"""
+            nonlocal latest_sort
+            for i, book in enumerate(books):
+                book_id = book.get('bookId')
+                title = book.get('title', '未知标题')
+                if not book_id:
+                    on_error(book, "书籍ID缺失")
+                    continue
+                print(f"\n正在处理 [{i+1}/{len(books)}]: {title}")
+
+                # 检查书籍是否已存在
+                marker = notebook_marker(book)
+                existing_page_id, stored_marker, stored_hash = notion_sink.lookup(book_id)
+                # 每个输出各自判断是否已是最新，全部最新时整本书跳过；--book 指定的书总是重新同步
+                sinks = [sink for sink in local_sinks if force or not sink.is_current(book_id, marker)]
+                # 划线数按笔记本条目估算，写入方式需要切换时即使标记未变也要重新同步
+                if (force or not (existing_page_id and stored_marker == marker)
+                        or (existing_page_id and layout_changed(
+                            book_id, book.get('noteCount', 0) + book.get('reviewCount', 0),
+                            chapter_pages_threshold))):
+                    sinks.insert(0, notion_sink)
+                if not sinks:
+                    print(f"⏭️ 书籍未变化，跳过: {title}")
+                    incr_metric("books_unchanged")
+                    # 书架上的阅读进度有变化时才单独刷新阅读进度
+                    progress = progress_marker(book)
+                    if reading_stats.progress_changed(book_id, progress):
+                        unchanged_books.append((book_id, title, existing_page_id, progress))
+                    continue
+                latest_sort += 1
+                yield {
+                    "span": tracer.start_span("book", parent=run_span, book_id=book_id, title=title,
+                                              is_new=not existing_page_id,
+                                              sinks=[sink.name for sink in sinks]),
+                    "sinks": sinks,
+                    "book": book,
+                    "book_id": book_id,
+                    "title": title,
+                    "marker": marker,
+                    "sort": latest_sort,
+                    "existing_page_id": existing_page_id,
+                    "stored_hash": stored_hash,
+                    "force": force,
+                }
+
+        def write_stage(job):
+            if lease is not None and lease.lost.is_set():
+                stop_event.set()
+                raise RuntimeError("租约已被其他运行接管，停止写入")
+            futures = [sink_executor.submit(sink.write, job) for sink in job["sinks"] if sink is not notion_sink]
+            try:
+                if notion_sink in job["sinks"]:
+                    notion_sink.write(job)
+            finally:
+                wait(futures)
+            for future in futures:
+                future.result()
+            # 所有输出都写入成功后才记录响应哈希，失败或被中止的书下次会重新渲染
+            if weread_http_cache is not None:
+                weread_http_cache.record_written(job["book_id"], job.get("response_hashes"),
+                                                 job.get("content_hash"))
+            record_reading_stats(reading_stats, job)
+            with counts_lock:
+                counts["success"] += 1
+            if job.get("span"):
+                job["span"].end(status="ok")
+            return job
+
+        plans = []
+
+        def plan_stage(job):
+            plan = plan_book(job, chapter_pages_threshold)
+            if notion_sink not in job["sinks"]:
+                # 只有本地镜像需要更新
+                plan["action"] = "local"
+                plan["ops"] = {name: (count if name == "weread" else 0) for name, count in plan["ops"].items()}
+            with counts_lock:
+                plans.append(plan)
+                counts["success"] += 1
+            if job.get("span"):
+                job["span"].end(status="planned")
+            return job
+
+        stages = [
+            PipelineStage("fetch", lambda job: fetch_book(session, job, weread_token, save_snapshot=not dry_run),
+                          fetch_workers, queue_size),
+            PipelineStage("render", lambda job: render_book(job, chapter_pages_threshold),
+                          render_workers, queue_size),
+            PipelineStage("plan", plan_stage, 1, queue_size) if dry_run
+            else PipelineStage("write", write_stage, write_workers, queue_size),
+        ]
+        run_pipeline(shelf_jobs(), stages, stop_event, on_error)
+        sink_executor.shutdown()
+        if dry_run:
+            # 不保存HTTP缓存 - 否则下次正式运行会误以为内容已经写入
+            print_run_metrics()
+            return {**print_sync_plan(plans, RUN_METRICS.get("books_unchanged", 0), fetch_workers),
+                    "error": counts["error"]}
+        if lease is not None and lease.lost.is_set():
+            # 其他运行已经在写这个数据库，不再发送缓冲的属性和看板
+            print("❌ 租约已失效，放弃剩余的Notion写入")
+            print_run_metrics()
+            return {**counts, "total": len(books)}
+        if unchanged_books and not stop_event.is_set():
+            with stage_timer("progress"):
+                refresh_reading_progress(session, reading_stats, write_buffer, unchanged_books, fetch_workers)
+        for sink in [notion_sink] + local_sinks:
+            sink.save()
+        if dashboard_page_id and (reading_stats.changed or reading_stats.dashboard.get("page_id") != dashboard_page_id):
+            with stage_timer("dashboard"):
+                update_dashboard(dashboard_page_id, reading_stats, notion_token)
+        reading_stats.save()
+        # 只有完整且没有失败的同步才更新书架摘要，否则下次 probe 仍会触发同步
+        if not filters and counts["error"] == 0 and not stop_event.is_set():
+            save_shelf_digest(digest)
+        if weread_http_cache is not None:
+            weread_http_cache.save()
         
-        print(f"\n🎉 同步完成！成功: {success_count}, 失败: {error_count}, 总计: {len(books)}")
+        print(f"\n🎉 同步完成！成功: {counts['success']}, 失败: {counts['error']}, 总计: {len(books)}")
+        print_run_metrics()
+        return {**counts, "total": len(books)}
         
         
     except Exception as e:
         print(f"❌ 同步过程出现严重错误: {e}")
+        print_run_metrics()
         return
 
-if __name__ == "__main__":
+def rerender(notion_token, database_id, chapter_pages_threshold=CHAPTER_PAGES_THRESHOLD, max_workers=4,
+             lease=None):
+    """用本地快照重新生成并替换页面内容 - 不访问微信读书；租约被接管后不再写入新的书
+
+    返回 {"success": 成功数, "error": 失败数, "total": 快照总数}，无法读取数据库索引时返回None
+    """
+    book_ids = list_snapshot_book_ids()
+    if not book_ids:
+        print("ℹ️ 没有本地快照，请先运行一次同步")
+        return {"success": 0, "error": 0, "total": 0}
+    notion_index = load_notion_index(database_id, notion_token)
+    if notion_index is None:
+        return
+
+    def render_one(book_id):
+        with tracer.span("book", parent=run_span, book_id=book_id):
+            return _rerender_book(book_id)
+
+    def _rerender_book(book_id):
+        if lease is not None and lease.lost.is_set():
+            return False
+        entry = notion_index.get(book_id)
+        snapshot = load_book_snapshot(book_id)
+        if not entry or not snapshot:
+            print(f"⚠️ 找不到页面或快照，跳过: {book_id}")
+            return False
+        children, _ = get_children(snapshot["chapter"], snapshot["bookmark_list"],
+                                   snapshot["summary"], snapshot["reviews"])
+        if not children:
+            return False
+        results = write_book_content(entry["page_id"], book_id, children, len(snapshot["bookmark_list"]),
+                                     notion_token, is_new=False,
+                                     chapter_pages_threshold=chapter_pages_threshold)
+        if results:
+            save_book_digest(entry["page_id"], snapshot["marker"], _blocks_hash(children),
+                             database_id, notion_token)
+        return bool(results)
+
+    run_span = tracer.current()
+    print(f"🎨 重新渲染 {len(book_ids)} 本书，并发 {max_workers}")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(render_one, book_ids))
+    print(f"\n🎉 重新渲染完成！成功: {sum(results)}, 失败: {len(results) - sum(results)}")
+    print_run_metrics()
+    return {"success": sum(results), "error": len(results) - sum(results), "total": len(results)}
+
+def create_run_lease(kind, database_id, notion_token):
+    """按类型创建租约: notion 锁页面 / file 本地锁文件 / none 不加锁"""
+    if kind == "none":
+        return None
+    if kind == "file":
+        return FileLease(LEASE_FILE, ttl=LEASE_TTL)
+    # 租约写在摘要属性中，先确保属性存在
+    ensure_digest_property(database_id, notion_token)
+    return NotionLease(database_id, lambda method, endpoint, payload=None:
+                       notion_api_request(method, endpoint, payload, notion_token),
+                       DIGEST_PROPERTY, ttl=LEASE_TTL)
+
+def run_exit_code(result):
+    """运行结果 → 退出码: 中途无法继续（None）或有失败的书时为1"""
+    if result is None or result.get("error"):
+        return 1
+    return 0
+
+def cli(argv=None):
+    """命令行入口 - 不带子命令时默认为 sync，兼容原有的三个位置参数"""
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if not argv or argv[0] not in ("sync", "rerender", "dedupe", "probe"):
+        argv.insert(0, "sync")
+
     parser = argparse.ArgumentParser(description='同步微信读书到Notion')
-    parser.add_argument('weread_token', help='微信读书Cookie')
-    parser.add_argument('notion_token', help='Notion集成Token')
-    parser.add_argument('database_id', help='Notion数据库ID')
-    
-    args = parser.parse_args()
-    
-    main(args.weread_token, args.notion_token, args.database_id)
\ No newline at end of file
+    subparsers = parser.add_subparsers(dest='command')
+
+    sync_parser = subparsers.add_parser('sync', help='同步微信读书到Notion（默认）')
+    sync_parser.add_argument('weread_token', help='微信读书Cookie')
+    sync_parser.add_argument('notion_token', help='Notion集成Token')
+    sync_parser.add_argument('database_id', help='Notion数据库ID')
+
+    rerender_parser = subparsers.add_parser('rerender', help='用本地快照重新生成Notion页面内容，不访问微信读书')
+    rerender_parser.add_argument('notion_token', help='Notion集成Token')
+    rerender_parser.add_argument('database_id', help='Notion数据库ID')
+    sync_parser.add_argument('--fetch-workers', type=int, default=2, help='抓取阶段线程数')
+    sync_parser.add_argument('--render-workers', type=int, default=1, help='渲染阶段线程数')
+    sync_parser.add_argument('--write-workers', type=int, default=2, help='写入阶段线程数')
+    sync_parser.add_argument('--queue-size', type=int, default=4, help='阶段之间的队列深度')
+    sync_parser.add_argument('--max-errors', type=int, default=1, help='失败书籍数达到该值时停止同步')
+    sync_parser.add_argument('--book', action='append', metavar='ID_OR_TITLE',
+                             help='只同步指定的书（BookId或书名），可重复；指定的书不论是否变化都重新写入')
+    sync_parser.add_argument('--since', metavar='YYYY-MM-DD', help='只同步该日期之后有笔记更新的书')
+    sync_parser.add_argument('--category', help='只同步分类名称包含该文字的书')
+    sync_parser.add_argument('--status', choices=['在读', '读完'], help='只同步该阅读状态的书（按数据库中的Status）')
+    sync_parser.add_argument('--dry-run', action='store_true',
+                             help='只抓取和渲染，输出同步计划、预计请求数和耗时，不写入Notion')
+    sync_parser.add_argument('--markdown', metavar='DIR', help='同时把笔记写成Markdown文件到DIR（每本书一个文件）')
+    sync_parser.add_argument('--jsonl', metavar='DIR', help='同时把笔记写成JSONL文件到DIR（每本书一个文件）')
+    sync_parser.add_argument('--dashboard', metavar='PAGE_ID', default=DASHBOARD_PAGE_ID,
+                             help='在该页面中维护阅读统计看板（也可用环境变量 WEREAD_DASHBOARD_PAGE_ID）')
+
+    rerender_parser.add_argument('--workers', type=int, default=4, help='并发写入的书籍数')
+
+    dedupe_parser = subparsers.add_parser('dedupe', help='只执行重复页面清理（同一BookId保留最早的页面），不访问微信读书')
+    dedupe_parser.add_argument('notion_token', help='Notion集成Token')
+    dedupe_parser.add_argument('database_id', help='Notion数据库ID')
+
+    probe_parser = subparsers.add_parser(
+        'probe', help=f'只请求一次笔记本列表判断是否需要同步: 退出码0需要同步，{PROBE_UNCHANGED_EXIT}没有变化')
+    probe_parser.add_argument('weread_token', help='微信读书Cookie')
+
+    for sub in (sync_parser, rerender_parser):
+        sub.add_argument('--chapter-pages', type=int, default=CHAPTER_PAGES_THRESHOLD, metavar='N',
+                         help='划线数达到N的书按章节拆分为子页面，0表示不拆分')
+    for sub in (sync_parser, rerender_parser, dedupe_parser):
+        sub.add_argument('--lease', choices=['notion', 'file', 'none'], default='notion',
+                         help='运行级租约: notion 在数据库中加锁页面（跨机器），file 使用本地锁文件，none 不加锁')
+        sub.add_argument('--lease-wait', type=int, default=0, metavar='SECONDS',
+                         help=f'租约被其他运行持有时最多等待的秒数，0表示立即退出（退出码{LEASE_BUSY_EXIT}）')
+        sub.add_argument('--record', metavar='FILE', help='把本次运行的所有HTTP请求录制到cassette文件(.jsonl.gz)')
+        sub.add_argument('--replay', metavar='FILE', help='从cassette文件回放HTTP响应，不访问网络')
+        sub.add_argument('--replay-latency', choices=['zero', 'original'], default='zero',
+                         help='回放时的延迟: zero 立即返回, original 按录制时的耗时等待')
+        sub.add_argument('--trace', metavar='FILE', help='把运行、书籍、HTTP请求的耗时span写入JSONL文件')
+        sub.add_argument('--profile', nargs='?', const='profile', metavar='DIR',
+                         help='在分析器下运行，输出 .pstats、折叠栈和各阶段耗时到DIR（默认 profile/）')
+
+    args = parser.parse_args(argv)
+    if args.command == 'probe':
+        return probe(args.weread_token)
+
+    def run():
+        if args.trace:
+            tracer.open(args.trace)
+        try:
+            with tracer.span(f"{args.command}_run"):
+                return run_command()
+        finally:
+            tracer.close()
+
+    def run_command():
+        # 预演和回放不写入Notion，不需要租约
+        kind = 'none' if args.replay or getattr(args, 'dry_run', False) else args.lease
+        lease = create_run_lease(kind, args.database_id, args.notion_token)
+        if lease is None:
+            return run_locked(None)
+        try:
+            lease.acquire(args.lease_wait)
+        except LeaseBusy as busy:
+            print(f"🔒 {busy}，本次不运行")
+            return LEASE_BUSY_EXIT
+        except Exception as e:
+            print(f"❌ 获取租约失败: {e}")
+            return 1
+        with lease:
+            code = run_locked(lease)
+        if lease.lost.is_set():
+            return 1
+        return code
+
+    def run_locked(lease):
+        if args.command == 'rerender':
+            result = rerender(args.notion_token, args.database_id, args.chapter_pages, args.workers, lease)
+        elif args.command == 'dedupe':
+            result = dedupe_book_pages(args.database_id, args.notion_token)
+        else:
+            result = main(args.weread_token, args.notion_token, args.database_id, args.chapter_pages,
+                 args.fetch_workers, args.render_workers, args.write_workers, args.queue_size,
+                 args.max_errors, args.dashboard, args.dry_run,
+                 {"book": args.book, "since": args.since, "category": args.category, "status": args.status},
+                 {"markdown": args.markdown, "jsonl": args.jsonl}, lease)
+        return run_exit_code(result)
+
+    def run_with_transport():
+        if args.record or args.replay:
+            from cassette import use_cassette
+            if args.replay:
+                # 回放不访问Notion，不需要按限流排队
+                notion_pacer.interval = 0.0
+                with use_cassette(args.replay, "replay", args.replay_latency):
+                    return run()
+            else:
+                with use_cassette(args.record, "record"):
+                    return run()
+        else:
+            return run()
+
+    if args.profile:
+        from profiling import RunProfiler
+        profiler = RunProfiler(args.profile)
+        profiler.start()
+        try:
+            return run_with_transport()
+        finally:
+            profiler.stop(STAGE_TIMES)
+    else:
+        return run_with_transport()
+
+if __name__ == "__main__":
+    sys.exit(cli())